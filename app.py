@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, Response, abort, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, send_from_directory, Response, abort, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -6,27 +6,42 @@ from datetime import datetime, timedelta
 import os
 import pandas as pd
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill
 import plotly.graph_objs as go
 import plotly.utils
+from moteur_indicateurs import COLONNES_RELEVES, calculer_series, series_json, statistiques_par_periode
 import json
-from werkzeug.utils import secure_filename
+import hashlib
+from werkzeug.utils import secure_filename, safe_join
 from sqlalchemy import func, text, case
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from typing import Union, Tuple
 from fpdf import FPDF
-import matplotlib.pyplot as plt
+from graphiques import cle_graphique, rendre_graphique
+from cache_disque import CacheDisque, cle_contenu
+from images import est_variante, fichiers_photo, nom_variante, traiter_photo
+from courriel import ecrire_message, envoyer_message, taille_brute_max
+from stockage import ParcoursDossiers, taille_base
+from archives import ArchiveReleves
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import io
 import tempfile
-from sqlalchemy.orm import relationship
+import mimetypes
+from sqlalchemy.orm import relationship, aliased
 from functools import wraps
+from itertools import groupby
+import heapq
+from urllib.parse import quote
 import shutil
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 import zipfile
-from threading import Thread
+from threading import Thread, Event, Lock
+import sqlite3
+import gzip
+import time
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'votre_cle_secrete_ici'
@@ -53,6 +68,40 @@ else:
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
+# Sauvegardes SQLite : au plus une sauvegarde par fenêtre, N sauvegardes conservées
+app.config['BACKUP_INTERVAL_SECONDS'] = int(os.environ.get('BACKUP_INTERVAL_SECONDS', 300))
+app.config['BACKUP_RETENTION'] = int(os.environ.get('BACKUP_RETENTION', 5))
+
+# Graphiques du rapport PDF : images en cache et processus de rendu
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['GRAPHIQUES_WORKERS'] = int(os.environ.get('GRAPHIQUES_WORKERS', min(4, os.cpu_count() or 1)))
+# Taille maximale de chaque cache disque (Mo) ; au-delà, les entrées les moins lues sont supprimées
+app.config['CACHE_GRAPHIQUES_MAX_MO'] = int(os.environ.get('CACHE_GRAPHIQUES_MAX_MO', 100))
+app.config['CACHE_RAPPORTS_MAX_MO'] = int(os.environ.get('CACHE_RAPPORTS_MAX_MO', 100))
+
+# Relevés de plus de RELEVES_CONSERVATION_JOURS : archivés (CSV gzip par site et par année)
+# avant d'être supprimés de la table
+app.config['ARCHIVES_FOLDER'] = os.environ.get('ARCHIVES_FOLDER', 'archives')
+
+# Photos du relevé du 20 : traitement (orientation, réduction, variantes) après l'upload
+app.config['PHOTOS_WORKERS'] = int(os.environ.get('PHOTOS_WORKERS', 2))
+# Débitmètres à photographier, ex. '{"SMP": ["Exhaure 1"], "LPZ": ["Exhaure 1"]}' ;
+# sans configuration : les exhaures et retours de chaque site (TypeReleve)
+app.config['DEBITMETRES_RELEVE_20'] = json.loads(os.environ.get('DEBITMETRES_RELEVE_20', 'null'))
+# Taille maximale d'un email, pièces jointes encodées comprises : au-delà, le ZIP
+# d'un relevé du 20 est découpé en plusieurs envois numérotés
+app.config['MAIL_TAILLE_MAX_MO'] = int(os.environ.get('MAIL_TAILLE_MAX_MO', 20))
+
+# Espace disponible (offre d'hébergement) : au-delà de 80 %, nettoyage automatique.
+# Mesure relue en arrière-plan toutes les STOCKAGE_INTERVALLE_SECONDES secondes
+app.config['STOCKAGE_LIMITE_MO'] = int(os.environ.get('STOCKAGE_LIMITE_MO', 1024))
+app.config['STOCKAGE_INTERVALLE_SECONDES'] = int(os.environ.get('STOCKAGE_INTERVALLE_SECONDES', 300))
+
+# Fichiers d'upload : 'nginx' (X-Accel-Redirect) ou 'apache' (X-Sendfile) pour laisser
+# le serveur frontal envoyer les octets ; vide : servis par Flask
+app.config['UPLOADS_SENDFILE'] = os.environ.get('UPLOADS_SENDFILE', '')
+app.config['UPLOADS_ACCEL_PREFIX'] = os.environ.get('UPLOADS_ACCEL_PREFIX', '/_uploads/')
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -61,6 +110,19 @@ login_manager.login_view = 'login'  # type: ignore
 # Créer le dossier uploads s'il n'existe pas
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Caches disque partagés par les workers (bornés en taille, éviction LRU)
+cache_graphiques = CacheDisque(app.config['CACHE_FOLDER'],
+                               app.config['CACHE_GRAPHIQUES_MAX_MO'] * 1024 * 1024, '.png')
+cache_rapports = CacheDisque(os.path.join(app.config['CACHE_FOLDER'], 'rapports'),
+                             app.config['CACHE_RAPPORTS_MAX_MO'] * 1024 * 1024, '.pdf')
+archive_releves = ArchiveReleves(app.config['ARCHIVES_FOLDER'])
+RELEVES_CONSERVATION_JOURS = 1825  # relevés et débits journaliers gardés en table (5 ans)
+
+def lit_archive(date_debut):
+    """Vrai si la période commençant à date_debut (None : depuis toujours) dépasse la
+    fenêtre chaude : les relevés archivés sont tous antérieurs à aujourd'hui - conservation"""
+    return date_debut is None or date_debut < datetime.now().date() - timedelta(days=RELEVES_CONSERVATION_JOURS)
+
 # Modèles de base de données
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -92,6 +154,35 @@ class Releve(db.Model):
     commentaire = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Un seul relevé par type et par jour (cible du ON CONFLICT de upsert_releves)
+    __table_args__ = (
+        db.Index('uq_releve_type_date', 'type_releve_id', 'date', unique=True),
+    )
+
+class ConsommationJournaliere(db.Model):
+    """Débit des totalisateurs : différence avec le relevé précédent, tenue à jour à chaque écriture"""
+    id = db.Column(db.Integer, primary_key=True)
+    type_releve_id = db.Column(db.Integer, db.ForeignKey('type_releve.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    date_precedente = db.Column(db.Date, nullable=False)  # date du relevé précédent (peut dater de plusieurs jours)
+    valeur = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_consommation_type_date', 'type_releve_id', 'date', unique=True),
+    )
+
+class CompletionJour(db.Model):
+    """Jours où un site ('releve', site_id) ou une routine ('routine', formulaire_id) a été saisi,
+    tenus à jour à chaque écriture pour le tableau de bord"""
+    id = db.Column(db.Integer, primary_key=True)
+    type_entite = db.Column(db.String(20), nullable=False)  # 'releve' ou 'routine'
+    entite_id = db.Column(db.Integer, nullable=False)  # site_id ou formulaire_id
+    date = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_completion_entite_date', 'type_entite', 'entite_id', 'date', unique=True),
+    )
+
 class PhotoReleve(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.Date, nullable=False)
@@ -103,6 +194,17 @@ class PhotoReleve(db.Model):
     session_id = db.Column(db.String(50), nullable=False)  # Identifiant unique de la session de relevé
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_photo_releve_session', 'session_id'),
+        db.Index('ix_photo_releve_date', 'date'),
+    )
+
+class TraitementPhoto(db.Model):
+    """Traitement d'une photo (orientation, réduction, variantes) ; pas de ligne : pas encore traitée"""
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo_releve.id'), primary_key=True)
+    statut = db.Column(db.String(20), nullable=False, default='en_cours')  # 'en_cours', 'termine', 'erreur'
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # Modèles pour les routines d'exploitation
 class FormulaireRoutine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -129,41 +231,245 @@ class ReponseRoutine(db.Model):
     utilisateur_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# Cache des réponses partagé entre les workers gunicorn (stocké en base)
+class VersionDonnees(db.Model):
+    """Version des données d'une portée ('site:1', 'routines'), incrémentée à chaque écriture"""
+    portee = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class CacheReponse(db.Model):
+    cle = db.Column(db.String(40), primary_key=True)  # sha1 de route + paramètres + version
+    contenu = db.Column(db.Text)  # JSON de la réponse, NULL tant que le calcul est en cours
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class ResetRegularite(db.Model):
+    """Date à partir de laquelle la régularité d'un relevé ou d'une routine est recalculée"""
+    id = db.Column(db.Integer, primary_key=True)
+    type_entite = db.Column(db.String(20), nullable=False)  # 'releve' ou 'routine'
+    nom = db.Column(db.String(100), nullable=False)  # 'Relevé SMP' ou nom du formulaire
+    date_reset = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_reset_regularite_entite', 'type_entite', 'nom', unique=True),
+    )
+
+# File des rapports PDF générés en tâche de fond
+class TacheRapport(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cle = db.Column(db.String(40), unique=True, nullable=False)  # sha1 des paramètres + versions des données
+    parametres = db.Column(db.Text, nullable=False)  # JSON {date_debut, date_fin, sites}
+    statut = db.Column(db.String(20), nullable=False, default='en_attente', index=True)  # 'en_attente', 'en_cours', 'termine', 'erreur'
+    progression = db.Column(db.Integer, nullable=False, default=0)  # 0 à 100
+    message = db.Column(db.Text)
+    fichier = db.Column(db.String(255))  # PDF généré (dossier cache)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Emails en attente d'envoi (envoyés en tâche de fond, avec nouvelles tentatives)
+class Outbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    destinataire = db.Column(db.String(200), nullable=False)
+    sujet = db.Column(db.String(300), nullable=False)
+    corps = db.Column(db.Text, nullable=False)  # HTML
+    pieces_jointes = db.Column(db.Text, nullable=False, default='[]')  # JSON [{path, filename, temporaire}]
+    session_id = db.Column(db.String(50), index=True)  # relevé du 20 : photos supprimées une fois tout le lot envoyé
+    lot = db.Column(db.String(100))  # emails d'un même envoi (ZIP découpé en plusieurs parties)
+    statut = db.Column(db.String(20), nullable=False, default='en_attente', index=True)  # 'en_attente', 'en_cours', 'envoye', 'erreur'
+    tentatives = db.Column(db.Integer, nullable=False, default=0)
+    prochain_essai = db.Column(db.DateTime, default=datetime.utcnow)
+    message = db.Column(db.Text)  # dernière erreur
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Point de reprise de la purge des données anciennes (une ligne par étape)
+class PurgeDonnees(db.Model):
+    etape = db.Column(db.String(30), primary_key=True)  # 'photos', 'releves', 'routines'...
+    date_limite = db.Column(db.Date, nullable=False)  # lignes antérieures supprimées
+    dernier_id = db.Column(db.Integer, nullable=False, default=0)  # lots déjà traités jusqu'à cet id
+    lignes = db.Column(db.Integer, nullable=False, default=0)
+    octets = db.Column(db.BigInteger, nullable=False, default=0)  # fichiers supprimés
+    statut = db.Column(db.String(20), nullable=False, default='en_cours')  # 'en_cours', 'termine'
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Nettoyage automatique : une seule exécution à la fois pour tous les workers (ligne unique)
+class NettoyageAuto(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    statut = db.Column(db.String(20), nullable=False, default='arme')  # 'arme', 'en_cours', 'desarme'
+    declenche_le = db.Column(db.DateTime)
+    termine_le = db.Column(db.DateTime)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+CACHE_DUREE = timedelta(hours=24)       # les entrées plus anciennes sont purgées
+CACHE_ATTENTE_MAX_SECONDES = 2          # attente du calcul lancé ailleurs, puis 503 + Retry-After
+CACHE_ABANDON_SECONDES = 20             # réservation plus ancienne : worker tué, la clé est reprise
+CALCUL_EN_COURS = object()              # retour de lire_ou_reserver_cache : calcul en cours ailleurs
+_verrous_cache = {}  # clé -> [verrou, nombre de requêtes qui l'utilisent]
+_verrous_cache_lock = Lock()
+
+def incrementer_versions(portees):
+    """Invalide le cache des portées données (dans la transaction en cours)"""
+    portees = sorted(set(portees))
+    if not portees:
+        return
+    table = VersionDonnees.__table__
+    dialecte = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialecte == 'postgresql' else sqlite.insert
+    stmt = insert(table).values([{'portee': p, 'version': 1} for p in portees])
+    stmt = stmt.on_conflict_do_update(index_elements=['portee'], set_={'version': table.c.version + 1})
+    db.session.execute(stmt)
+
+def releves_modifies(type_ids):
+    """Invalide le cache des sites auxquels appartiennent ces types de relevé
+    (et la portée 'releves', commune à tous les sites)"""
+    sites = db.session.query(TypeReleve.site_id).filter(TypeReleve.id.in_(list(type_ids))).distinct()
+    incrementer_versions([f'site:{site_id}' for (site_id,) in sites] + ['releves'])
+
+def lire_version(portee):
+    return db.session.execute(
+        db.select(VersionDonnees.version).where(VersionDonnees.portee == portee)
+    ).scalar() or 0
+
+def lire_versions(portees):
+    """Versions de plusieurs portées en une requête"""
+    versions = dict(db.session.execute(
+        db.select(VersionDonnees.portee, VersionDonnees.version).where(VersionDonnees.portee.in_(portees))
+    ).all())
+    return [versions.get(p, 0) for p in portees]
+
+def reponse_en_cache(portee):
+    """Met en cache la réponse JSON d'une route GET, clé = route + paramètres + version de la portée
+    (ou des portées, si `portee` en renvoie une liste).
+    Répond 304 si le client a déjà cette version (ETag), et un seul worker calcule une clé manquante"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            portees = portee(**kwargs)
+            if isinstance(portees, str):
+                portees = [portees]
+            versions = ','.join(f'{p}:{v}' for p, v in zip(portees, lire_versions(portees)))
+            # La date du jour fait partie de la clé : les périodes "30 derniers jours" glissent
+            cle_brute = '|'.join([
+                request.path, str(sorted(request.args.items(multi=True))),
+                versions, datetime.now().date().isoformat()
+            ])
+            cle = hashlib.sha1(cle_brute.encode('utf-8')).hexdigest()
+            
+            if request.if_none_match.contains(cle):
+                reponse = Response(status=304)
+                reponse.set_etag(cle)
+                return reponse
+            
+            # Dans ce worker, les requêtes simultanées sur la même clé attendent la première ;
+            # le verrou reste dans le dictionnaire tant qu'une requête l'utilise
+            with _verrous_cache_lock:
+                entree = _verrous_cache.setdefault(cle, [Lock(), 0])
+                entree[1] += 1
+            verrou = entree[0]
+            try:
+                if not verrou.acquire(timeout=CACHE_ATTENTE_MAX_SECONDES):
+                    return calcul_en_cours()
+                try:
+                    contenu = lire_ou_reserver_cache(cle)
+                    if contenu is CALCUL_EN_COURS:
+                        return calcul_en_cours()
+                    if contenu is None:
+                        try:
+                            reponse = f(*args, **kwargs)
+                        except Exception:
+                            liberer_cache(cle)  # ex. abort(404) : ne pas bloquer les autres workers
+                            raise
+                        if not isinstance(reponse, Response) or reponse.status_code != 200:
+                            liberer_cache(cle)
+                            return reponse
+                        contenu = reponse.get_data(as_text=True)
+                        enregistrer_cache(cle, contenu)
+                finally:
+                    verrou.release()
+            finally:
+                with _verrous_cache_lock:
+                    entree[1] -= 1
+                    if entree[1] == 0:
+                        del _verrous_cache[cle]
+            
+            reponse = Response(contenu, mimetype='application/json')
+            reponse.set_etag(cle)
+            reponse.headers['Cache-Control'] = 'private, no-cache'
+            return reponse
+        return decorated_function
+    return decorator
+
+def calcul_en_cours():
+    """Réponse 503 quand le calcul de la clé, lancé ailleurs, n'est pas terminé"""
+    reponse = jsonify({'error': 'Calcul en cours, réessayez dans quelques secondes'})
+    reponse.status_code = 503
+    reponse.headers['Retry-After'] = str(CACHE_ATTENTE_MAX_SECONDES)
+    return reponse
+
+def lire_ou_reserver_cache(cle):
+    """Contenu en cache, ou None après avoir réservé la clé pour ce worker.
+    Si un autre worker calcule déjà cette clé, on attend son résultat au plus
+    CACHE_ATTENTE_MAX_SECONDES, puis on retourne CALCUL_EN_COURS"""
+    debut = time.monotonic()
+    while True:
+        entree = db.session.execute(
+            db.select(CacheReponse.contenu, CacheReponse.created_at).where(CacheReponse.cle == cle)
+        ).first()
+        if entree is None:
+            try:
+                db.session.add(CacheReponse(cle=cle))
+                db.session.commit()
+                return None
+            except IntegrityError:
+                # Un autre worker vient de réserver la clé
+                db.session.rollback()
+                continue
+        if entree.contenu is not None:
+            return entree.contenu
+        # Calcul en cours ailleurs : réservation abandonnée (worker tué), ou attente trop longue
+        if (datetime.utcnow() - entree.created_at).total_seconds() > CACHE_ABANDON_SECONDES:
+            return None
+        if time.monotonic() - debut > CACHE_ATTENTE_MAX_SECONDES:
+            db.session.rollback()
+            return CALCUL_EN_COURS
+        db.session.rollback()
+        time.sleep(0.1)
+
+def enregistrer_cache(cle, contenu):
+    try:
+        CacheReponse.query.filter(CacheReponse.created_at < datetime.utcnow() - CACHE_DUREE).delete()
+        inserer_ou_maj(CacheReponse.__table__, [{'cle': cle, 'contenu': contenu, 'created_at': datetime.utcnow()}],
+                       ['cle'], ['contenu', 'created_at'])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erreur lors de l'écriture du cache: {e}")
+
+def liberer_cache(cle):
+    try:
+        CacheReponse.query.filter(CacheReponse.cle == cle, CacheReponse.contenu.is_(None)).delete()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+def portee_type_releve(type_releve_id):
+    type_releve = db.session.get(TypeReleve, type_releve_id)
+    return f'site:{type_releve.site_id}' if type_releve else 'site:0'
+
 # Routes principales
 @app.route('/')
 @login_required
 def index():
-    today = datetime.now().date()
-    # Statut relevés (join avec TypeReleve)
-    smp_fait = db.session.query(Releve).join(TypeReleve).filter(TypeReleve.site_id == 1, Releve.date == today).count() > 0
-    lpz_fait = db.session.query(Releve).join(TypeReleve).filter(TypeReleve.site_id == 2, Releve.date == today).count() > 0
-    releves_status = {
-        'SMP': smp_fait,
-        'LPZ': lpz_fait
-    }
-    # Calcul régularité relevés
+    # Statut et régularité de tous les sites et routines : une requête sur le calendrier des saisies
+    completions = completions_accueil(lire_resets_regularite())
+    releves_status = {}
     releves_regularite = {}
-    for nom, site_id in [('SMP', 1), ('LPZ', 2)]:
-        type_releves = TypeReleve.query.filter_by(site_id=site_id).all()
-        # On considère qu'un relevé est "fait" si au moins un relevé existe ce jour-là pour ce site
-        # Trouver la première date de relevé pour ce site (hors reset)
-        reset = RESET_REGULARITE.get(('releve', f'Relevé {nom}'))
-        first = db.session.query(Releve.date).join(TypeReleve).filter(TypeReleve.site_id == site_id)
-        if reset:
-            first = first.filter(Releve.date >= reset)
-        first = first.order_by(Releve.date.asc()).first()
-        if first:
-            date_debut = first[0]
-            jours = (today - date_debut).days + 1
-            total = db.session.query(Releve.date).join(TypeReleve).filter(TypeReleve.site_id == site_id, Releve.date >= date_debut).distinct().count()
-            regularite = int(100 * total / jours) if jours > 0 else 0
-        else:
-            regularite = 0
-        releves_regularite[nom] = regularite
+    for nom in ['SMP', 'LPZ']:
+        completion = completions.get(('releve', nom), {'fait': False, 'regularite': 0})
+        releves_status[nom] = completion['fait']
+        releves_regularite[nom] = completion['regularite']
     # Routines fixes
     routines_list = [
         'STE PRINCIPALE SMP', 'STE CAB SMP', 'STEP SMP',
@@ -172,23 +478,9 @@ def index():
     routines_status = {}
     routines_regularite = {}
     for nom in routines_list:
-        formulaire = FormulaireRoutine.query.filter_by(nom=nom).first()
-        fait = False
-        regularite = 0
-        if formulaire:
-            fait = db.session.query(ReponseRoutine).filter(ReponseRoutine.formulaire_id == formulaire.id, ReponseRoutine.date_creation == today).count() > 0
-            reset = RESET_REGULARITE.get(('routine', nom))
-            first = db.session.query(ReponseRoutine.date_creation).filter(ReponseRoutine.formulaire_id == formulaire.id)
-            if reset:
-                first = first.filter(ReponseRoutine.date_creation >= reset)
-            first = first.order_by(ReponseRoutine.date_creation.asc()).first()
-            if first:
-                date_debut = first[0]
-                jours = (today - date_debut).days + 1
-                total = db.session.query(ReponseRoutine.date_creation).filter(ReponseRoutine.formulaire_id == formulaire.id, ReponseRoutine.date_creation >= date_debut).distinct().count()
-                regularite = int(100 * total / jours) if jours > 0 else 0
-        routines_status[nom] = fait
-        routines_regularite[nom] = regularite
+        completion = completions.get(('routine', nom), {'fait': False, 'regularite': 0})
+        routines_status[nom] = completion['fait']
+        routines_regularite[nom] = completion['regularite']
     return render_template('index.html', releves_status=releves_status, releves_regularite=releves_regularite, routines_list=routines_list, routines_status=routines_status, routines_regularite=routines_regularite, user_role=current_user.role)
 
 # Fonction utilitaire pour trouver la première page autorisée
@@ -274,12 +566,24 @@ def ajouter_releve():
             
             print(f"DEBUG /api/releve - Nouvelles valeurs: date={date_releve}, valeur={data['valeur']}, type_id={type_releve_id}")
             
+            ancien_type, ancienne_date = releve.type_releve_id, releve.date
             releve.valeur = data['valeur']
             releve.commentaire = data.get('commentaire', '')
             releve.date = date_releve
             releve.type_releve_id = type_releve_id
             releve.utilisateur_id = current_user.id
-            db.session.commit()
+            try:
+                db.session.flush()
+                # Débits touchés à l'ancienne et à la nouvelle position du relevé
+                maj_consommations(ancienne_date, [ancien_type])
+                maj_consommations(date_releve, [releve.type_releve_id])
+                maj_completions_releves(ancienne_date, [ancien_type])
+                maj_completions_releves(date_releve, [releve.type_releve_id])
+                releves_modifies([ancien_type, releve.type_releve_id])
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return jsonify({'success': False, 'message': 'Un relevé existe déjà pour ce type à cette date'}), 409
             print(f"DEBUG /api/releve - Relevé mis à jour avec succès")
             backup_database()  # Sauvegarde automatique après modification
             return jsonify({'success': True})
@@ -287,23 +591,11 @@ def ajouter_releve():
             print(f"DEBUG /api/releve - Relevé non trouvé pour ID: {data['id']}")
             return jsonify({'success': False, 'message': 'Relevé non trouvé'}), 404
     # Sinon, comportement existant (création ou update par date/type)
-    releve_existant = Releve.query.filter_by(
-        type_releve_id=data['type_releve_id'],
-        date=date_releve
-    ).first()
-    if releve_existant:
-        releve_existant.valeur = data['valeur']
-        releve_existant.commentaire = data.get('commentaire', '')
-        releve_existant.utilisateur_id = current_user.id
-    else:
-        nouveau_releve = Releve(
-            date=date_releve,
-            type_releve_id=data['type_releve_id'],
-            valeur=data['valeur'],
-            commentaire=data.get('commentaire', ''),
-            utilisateur_id=current_user.id
-        )
-        db.session.add(nouveau_releve)
+    upsert_releves(date_releve, [{
+        'type_releve_id': data['type_releve_id'],
+        'valeur': data['valeur'],
+        'commentaire': data.get('commentaire', '')
+    }], current_user.id)
     db.session.commit()
     backup_database()  # Sauvegarde automatique après création/modification
     return jsonify({'success': True})
@@ -314,36 +606,117 @@ def historique():
     sites = Site.query.all()
     return render_template('historique.html', sites=sites)
 
+# Pagination par curseur de l'historique (date décroissante, puis id de type croissant)
+HISTORIQUE_LIMITE_DEFAUT = 200
+HISTORIQUE_LIMITE_MAX = 1000
+
 @app.route('/api/historique/<int:site_id>')
 @login_required
 def get_historique(site_id):
     date_debut = request.args.get('date_debut')
     date_fin = request.args.get('date_fin')
+    type_releve_id = request.args.get('type_releve_id', type=int)
+    utilisateur = request.args.get('utilisateur')
+    recherche = request.args.get('q')
+    curseur = request.args.get('cursor')
+    limite = request.args.get('limit', HISTORIQUE_LIMITE_DEFAUT, type=int)
+    limite = max(1, min(limite, HISTORIQUE_LIMITE_MAX))
+    
+    # L'auteur est joint en SQL (plus de requête par ligne)
+    query = db.session.query(
+        Releve.id.label('id'),
+        Releve.date.label('date'),
+        Releve.type_releve_id.label('type_releve_id'),
+        TypeReleve.nom.label('type_releve'),
+        Releve.valeur.label('valeur'),
+        TypeReleve.unite.label('unite'),
+        Releve.commentaire.label('commentaire'),
+        func.coalesce(User.username, 'Inconnu').label('utilisateur')
+    ).join(
+        TypeReleve, Releve.type_releve_id == TypeReleve.id
+    ).outerjoin(
+        User, User.id == Releve.utilisateur_id
+    ).filter(TypeReleve.site_id == site_id)
     
-    query = db.session.query(Releve, TypeReleve).join(TypeReleve).filter(TypeReleve.site_id == site_id)
-    
-    if date_debut:
-        query = query.filter(Releve.date >= datetime.strptime(date_debut, '%Y-%m-%d').date())
-    if date_fin:
-        query = query.filter(Releve.date <= datetime.strptime(date_fin, '%Y-%m-%d').date())
+    try:
+        d1 = datetime.strptime(date_debut, '%Y-%m-%d').date() if date_debut else None
+        d2 = datetime.strptime(date_fin, '%Y-%m-%d').date() if date_fin else None
+    except ValueError:
+        return jsonify({'error': 'Format de date invalide'}), 400
+    if d1:
+        query = query.filter(Releve.date >= d1)
+    if d2:
+        query = query.filter(Releve.date <= d2)
+    if type_releve_id:
+        query = query.filter(Releve.type_releve_id == type_releve_id)
+    if utilisateur:
+        query = query.filter(User.username == utilisateur)
+    if recherche:
+        query = query.filter(Releve.commentaire.icontains(recherche, autoescape=True))  # '%' et '_' cherchés tels quels
+    
+    # Curseur "AAAA-MM-JJ_idtype" : dernière ligne de la page précédente
+    if curseur:
+        try:
+            curseur_date, curseur_type = curseur.split('_')
+            curseur = (datetime.strptime(curseur_date, '%Y-%m-%d').date(), int(curseur_type))
+        except ValueError:
+            return jsonify({'error': 'Curseur invalide'}), 400
+        query = query.filter(db.or_(
+            Releve.date < curseur[0],
+            db.and_(Releve.date == curseur[0], Releve.type_releve_id > curseur[1])
+        ))
     
     # Tri : date décroissante, puis id de TypeReleve croissant (ordre métier)
-    releves = query.order_by(Releve.date.desc(), TypeReleve.id.asc()).all()
-    
-    result = []
-    for releve, type_releve in releves:
-        user = db.session.get(User, releve.utilisateur_id)
-        result.append({
-            'id': releve.id,
-            'date': releve.date.strftime('%Y-%m-%d'),
-            'type_releve': type_releve.nom,
-            'valeur': releve.valeur,
-            'unite': type_releve.unite,
-            'commentaire': releve.commentaire,
-            'utilisateur': user.username if user else 'Inconnu'
-        })
-    
-    return jsonify(result)
+    lignes = [dict(ligne._mapping) for ligne in
+              query.order_by(Releve.date.desc(), Releve.type_releve_id.asc()).limit(limite + 1).all()]
+    if lit_archive(d1):
+        # Période au-delà de la fenêtre chaude : page fusionnée avec l'archive (la table l'emporte)
+        archives = releves_archives_historique(site_id, d1, d2, type_releve_id, utilisateur, recherche, curseur, limite + 1)
+        cles = {(ligne['date'], ligne['type_releve_id']) for ligne in lignes}
+        lignes += [ligne for ligne in archives if (ligne['date'], ligne['type_releve_id']) not in cles]
+        lignes.sort(key=lambda ligne: (-ligne['date'].toordinal(), ligne['type_releve_id']))
+    page_suivante = len(lignes) > limite
+    lignes = lignes[:limite]
+    
+    next_cursor = None
+    if page_suivante and lignes:
+        next_cursor = f"{lignes[-1]['date'].strftime('%Y-%m-%d')}_{lignes[-1]['type_releve_id']}"
+    
+    for releve in lignes:
+        releve['date'] = releve['date'].strftime('%Y-%m-%d')
+        releve.setdefault('archive', False)
+    return jsonify({'releves': lignes, 'next_cursor': next_cursor})
+
+def releves_archives_historique(site_id, date_debut, date_fin, type_releve_id, utilisateur, recherche, curseur, limite):
+    """Première page de relevés archivés d'un site, mêmes filtres et même tri que l'historique.
+    Ces lignes (archive=True) ne sont plus dans la table : ni modifiables ni supprimables"""
+    types = {tr.id: tr for tr in TypeReleve.query.filter_by(site_id=site_id)}
+    noms = dict(db.session.query(User.id, User.username).all())
+    df = archive_releves.lire([site_id], date_debut, date_fin)
+    df = df[df['type_releve_id'].isin(list(types))]
+    if type_releve_id:
+        df = df[df['type_releve_id'] == type_releve_id]
+    if utilisateur:
+        df = df[df['utilisateur_id'].map(noms) == utilisateur]
+    if recherche:
+        df = df[df['commentaire'].str.contains(recherche, case=False, regex=False, na=False)]
+    if curseur:
+        df = df[(df['date'] < curseur[0]) | ((df['date'] == curseur[0]) & (df['type_releve_id'] > curseur[1]))]
+    df = df.sort_values(['date', 'type_releve_id'], ascending=[False, True]).head(limite)
+    return [
+        {
+            'id': int(r.id),
+            'date': r.date,
+            'type_releve_id': int(r.type_releve_id),
+            'type_releve': types[r.type_releve_id].nom,
+            'valeur': float(r.valeur),
+            'unite': types[r.type_releve_id].unite,
+            'commentaire': r.commentaire,
+            'utilisateur': noms.get(r.utilisateur_id, 'Inconnu'),
+            'archive': True
+        }
+        for r in df.itertuples(index=False)
+    ]
 
 @app.route('/export_excel/<int:site_id>')
 @login_required
@@ -354,65 +727,79 @@ def export_excel(site_id):
     
     date_debut = request.args.get('date_debut')
     date_fin = request.args.get('date_fin')
+    try:
+        d1 = datetime.strptime(date_debut, '%Y-%m-%d').date() if date_debut else None
+        d2 = datetime.strptime(date_fin, '%Y-%m-%d').date() if date_fin else None
+    except ValueError:
+        return "Format de date invalide", 400
     
     # Récupérer tous les types de relevé (débitmètres) pour ce site, triés par id
     types_releve = TypeReleve.query.filter_by(site_id=site_id).order_by(TypeReleve.id).all()
     noms_debitmetres = [tr.nom for tr in types_releve]
-    id_debitmetres = {tr.id: tr.nom for tr in types_releve}
-    unites = {tr.nom: tr.unite for tr in types_releve}
-    
-    # Récupérer tous les relevés de la période
-    query = db.session.query(Releve).filter(Releve.type_releve_id.in_(id_debitmetres.keys()))
-    if date_debut:
-        query = query.filter(Releve.date >= datetime.strptime(date_debut, '%Y-%m-%d').date())
-    if date_fin:
-        query = query.filter(Releve.date <= datetime.strptime(date_fin, '%Y-%m-%d').date())
-    releves = query.all()
-    
-    # Construire le pivot : {date: {nom_debitmetre: valeur}}
-    donnees = {}
-    for r in releves:
-        d = r.date.strftime('%Y-%m-%d')
-        nom = id_debitmetres[r.type_releve_id]
-        if d not in donnees:
-            donnees[d] = {}
-        donnees[d][nom] = r.valeur
-    
-    # Toutes les dates de la période (même sans relevé)
-    if date_debut and date_fin:
-        d1 = datetime.strptime(date_debut, '%Y-%m-%d').date()
-        d2 = datetime.strptime(date_fin, '%Y-%m-%d').date()
-        toutes_les_dates = [(d1 + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((d2-d1).days+1)]
-    else:
-        toutes_les_dates = sorted(donnees.keys())
+    colonnes = {tr.id: i for i, tr in enumerate(types_releve)}
     
-    # Créer le fichier Excel
-    wb = Workbook()
-    ws = wb.active
-    if ws:
-        ws.title = f"Relevés {site.nom}"
-        
-        # En-têtes : Date + noms de débitmètres
-        ws.cell(row=1, column=1, value='Date').font = Font(bold=True)
-        for i, nom in enumerate(noms_debitmetres, 2):
-            cell = ws.cell(row=1, column=i, value=nom)
-            cell.font = Font(bold=True)
-        
-        # Données
-        for row, date in enumerate(toutes_les_dates, 2):
-            ws.cell(row=row, column=1, value=date)
-            for col, nom in enumerate(noms_debitmetres, 2):
-                valeur = donnees.get(date, {}).get(nom, '')
-                ws.cell(row=row, column=col, value=valeur)
-    
-    # Sauvegarder le fichier
+    # Relevés de la période triés par date : lus par lots, sans charger d'objets ORM
+    query = db.session.query(Releve.date, Releve.type_releve_id, Releve.valeur).filter(
+        Releve.type_releve_id.in_(colonnes.keys())
+    )
+    if d1:
+        query = query.filter(Releve.date >= d1)
+    if d2:
+        query = query.filter(Releve.date <= d2)
+    query = query.order_by(Releve.date, Releve.type_releve_id).yield_per(1000)
+    releves = query
+    if lit_archive(d1):
+        # Archive d'abord : à date et débitmètre égaux, la valeur de la table est écrite en dernier
+        archives = archive_releves.lire([site_id], d1, d2)
+        archives = archives[archives['type_releve_id'].isin(list(colonnes))]
+        releves = heapq.merge(archives.itertuples(index=False), query, key=lambda r: (r.date, r.type_releve_id))
+    
+    def lignes_pivot():
+        """Une ligne [date, valeur par débitmètre] par jour, construite au fil du curseur trié"""
+        jour_suivant = d1 if (d1 and d2) else None
+        for date, releves_jour in groupby(releves, key=lambda r: r.date):
+            # Toutes les dates de la période (même sans relevé)
+            while jour_suivant and jour_suivant < date:
+                yield [jour_suivant.strftime('%Y-%m-%d')] + [''] * len(colonnes)
+                jour_suivant += timedelta(days=1)
+            ligne = [''] * len(colonnes)
+            for r in releves_jour:
+                ligne[colonnes[r.type_releve_id]] = r.valeur
+            yield [date.strftime('%Y-%m-%d')] + ligne
+            if jour_suivant:
+                jour_suivant = date + timedelta(days=1)
+        while jour_suivant and jour_suivant <= d2:
+            yield [jour_suivant.strftime('%Y-%m-%d')] + [''] * len(colonnes)
+            jour_suivant += timedelta(days=1)
+    
+    # Classeur en écriture seule : les lignes ne restent pas en mémoire
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=f"Relevés {site.nom}")
+    
+    # En-têtes : Date + noms de débitmètres
+    entetes = []
+    for nom in ['Date'] + noms_debitmetres:
+        cell = WriteOnlyCell(ws, value=nom)
+        cell.font = Font(bold=True)
+        entetes.append(cell)
+    ws.append(entetes)
+    
+    # Données
+    for ligne in lignes_pivot():
+        ws.append(ligne)
+    
+    # Fichier temporaire anonyme, supprimé dès la fin de l'envoi (rien ne reste dans uploads/)
     filename = f"releves_{site.nom}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    wb.save(filepath)
+    fichier = tempfile.TemporaryFile()
+    wb.save(fichier)
+    fichier.seek(0)
     
-    print('DEBUG EXPORT EXCEL - Colonnes générées:', noms_debitmetres)
-    
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    return send_file(
+        fichier,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=filename
+    )
 
 @app.route('/indicateurs')
 @login_required
@@ -420,108 +807,88 @@ def indicateurs():
     sites = Site.query.all()
     return render_template('indicateurs.html', sites=sites)
 
+# Chargement des séries pour le moteur d'indicateurs : une seule requête par appel
+def charger_releves_indicateurs(date_debut, date_fin=None, site_ids=None, type_releve_id=None):
+    """Relevés de la période (avec le type et le site) dans un DataFrame pour moteur_indicateurs.
+    Les totalisateurs sont lus directement dans ConsommationJournaliere (débits précalculés)"""
+    def requete(modele, precalcule):
+        query = db.session.query(
+            modele.type_releve_id, TypeReleve.nom, TypeReleve.type_mesure, TypeReleve.unite,
+            Site.nom.label('site'), modele.date, modele.valeur, db.literal(precalcule).label('precalcule')
+        ).join(
+            TypeReleve, modele.type_releve_id == TypeReleve.id
+        ).join(
+            Site, Site.id == TypeReleve.site_id
+        ).filter(modele.date >= date_debut)
+        if date_fin:
+            query = query.filter(modele.date <= date_fin)
+        if site_ids is not None:
+            query = query.filter(TypeReleve.site_id.in_(site_ids))
+        if type_releve_id is not None:
+            query = query.filter(modele.type_releve_id == type_releve_id)
+        return query
+    
+    bruts = requete(Releve, False).filter(TypeReleve.type_mesure != 'totalisateur')
+    debits = requete(ConsommationJournaliere, True).filter(TypeReleve.type_mesure == 'totalisateur')
+    releves = pd.DataFrame(bruts.union_all(debits).all(), columns=COLONNES_RELEVES)
+    if lit_archive(date_debut):
+        # Relevés archivés : bruts (les débits des totalisateurs sont recalculés par différence)
+        releves = pd.concat([releves, releves_archives_indicateurs(date_debut, date_fin, site_ids, type_releve_id)],
+                            ignore_index=True).drop_duplicates(['type_releve_id', 'date'], keep='first')
+    releves['precalcule'] = releves['precalcule'].astype(bool)
+    return releves
+
+def releves_archives_indicateurs(date_debut, date_fin=None, site_ids=None, type_releve_id=None):
+    """Relevés archivés de la période, aux colonnes COLONNES_RELEVES.
+    Pour les totalisateurs, le dernier index archivé avant date_debut est ajouté : la différence
+    donne ainsi le débit du premier jour, et cette ligne disparaît après différenciation"""
+    query = db.session.query(
+        TypeReleve.id.label('type_releve_id'), TypeReleve.nom, TypeReleve.type_mesure, TypeReleve.unite,
+        Site.nom.label('site')
+    ).join(Site, Site.id == TypeReleve.site_id)
+    if site_ids is not None:
+        query = query.filter(TypeReleve.site_id.in_(site_ids))
+    if type_releve_id is not None:
+        query = query.filter(TypeReleve.id == type_releve_id)
+    types = pd.DataFrame(query.all(), columns=['type_releve_id', 'nom', 'type_mesure', 'unite', 'site'])
+    archives = archive_releves.lire(site_ids, date_debut, date_fin)
+    totalisateurs = types.loc[types['type_mesure'] == 'totalisateur', 'type_releve_id']
+    if date_debut and not totalisateurs.empty:
+        precedents = archive_releves.derniers_avant(site_ids, date_debut, totalisateurs)
+        archives = pd.concat([precedents, archives], ignore_index=True)
+    archives = archives[['type_releve_id', 'date', 'valeur']]
+    archives = archives.astype({'type_releve_id': 'int64'}).merge(types, on='type_releve_id')
+    return archives.assign(precalcule=False)[COLONNES_RELEVES]
+
 @app.route('/api/indicateurs/<int:site_id>')
 @login_required
+@reponse_en_cache(lambda site_id: f'site:{site_id}')
 def get_indicateurs(site_id):
     site = Site.query.get_or_404(site_id)
     jours = request.args.get('jours', 30, type=int)
     date_debut = datetime.now().date() - timedelta(days=jours)
     
-    # Récupérer tous les types de relevés du site
-    types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
-    
-    result = []
-    for type_releve in types_releve:
-        if type_releve.type_mesure == 'totalisateur':
-            # Calculer les débits journaliers pour les totalisateurs
-            releves = Releve.query.filter_by(type_releve_id=type_releve.id).filter(
-                Releve.date >= date_debut
-            ).order_by(Releve.date).all()
-            
-            if len(releves) > 1:
-                valeurs = []
-                for i in range(1, len(releves)):
-                    difference = releves[i].valeur - releves[i-1].valeur
-                    valeurs.append({
-                        'date': releves[i].date.strftime('%Y-%m-%d'),
-                        'valeur': difference
-                    })
-                
-                result.append({
-                    'nom': type_releve.nom,
-                    'unite': type_releve.unite,
-                    'valeurs': valeurs
-                })
-        elif type_releve.nom == 'Eau potable':
-            # Traitement spécial pour l'eau potable (hebdomadaire avec calcul de différence)
-            releves = Releve.query.filter_by(type_releve_id=type_releve.id).filter(
-                Releve.date >= date_debut
-            ).order_by(Releve.date).all()
-            
-            if len(releves) > 1:
-                valeurs = []
-                for i in range(1, len(releves)):
-                    difference = releves[i].valeur - releves[i-1].valeur
-                    # Calculer le numéro de semaine
-                    semaine = releves[i].date.isocalendar()
-                    semaine_label = f"S{semaine[1]}-{semaine[0]}"
-                    valeurs.append({
-                        'date': semaine_label,
-                        'valeur': difference
-                    })
-                
-                result.append({
-                    'nom': type_releve.nom,
-                    'unite': type_releve.unite,
-                    'valeurs': valeurs
-                })
-        elif type_releve.nom == 'Coagulant':
-            # Traitement spécial pour le coagulant (hebdomadaire sans calcul)
-            releves = Releve.query.filter_by(type_releve_id=type_releve.id).filter(
-                Releve.date >= date_debut
-            ).order_by(Releve.date).all()
-            
-            if releves:
-                valeurs = []
-                for releve in releves:
-                    # Calculer le numéro de semaine
-                    semaine = releve.date.isocalendar()
-                    semaine_label = f"S{semaine[1]}-{semaine[0]}"
-                    valeurs.append({
-                        'date': semaine_label,
-                        'valeur': releve.valeur
-                    })
-                
-                result.append({
-                    'nom': type_releve.nom,
-                    'unite': type_releve.unite,
-                    'valeurs': valeurs
-                })
-        else:
-            # Relevés basiques
-            releves = Releve.query.filter_by(type_releve_id=type_releve.id).filter(
-                Releve.date >= date_debut
-            ).order_by(Releve.date).all()
-            
-            if releves:
-                valeurs = [{
-                    'date': r.date.strftime('%Y-%m-%d'),
-                    'valeur': r.valeur
-                } for r in releves]
-                
-                result.append({
-                    'nom': type_releve.nom,
-                    'unite': type_releve.unite,
-                    'valeurs': valeurs
-                })
-    
-    return jsonify(result)
+    # Tous les types du site en une requête, calculs vectorisés
+    series = calculer_series(charger_releves_indicateurs(date_debut, site_ids=[site_id]))
+    return jsonify(series_json(series))
 
 @app.route('/releve_20')
 @login_required
 def releve_20():
     sites = Site.query.all()
-    return render_template('releve_20.html', sites=sites)
+    return render_template('releve_20.html', sites=sites, debitmetres=debitmetres_releve_20())
+
+def debitmetres_releve_20():
+    """{nom du site: [débitmètres à photographier le 20]}"""
+    if app.config['DEBITMETRES_RELEVE_20']:
+        return app.config['DEBITMETRES_RELEVE_20']
+    debitmetres = {}
+    lignes = db.session.query(Site.nom, TypeReleve.nom).join(TypeReleve, TypeReleve.site_id == Site.id).filter(
+        db.or_(TypeReleve.nom.like('Exhaure%'), TypeReleve.nom.in_(TYPES_RETOUR))
+    ).order_by(Site.id, TypeReleve.id)
+    for site_nom, nom in lignes:
+        debitmetres.setdefault(site_nom, []).append(nom)
+    return debitmetres
 
 @app.route('/api/upload_photo', methods=['POST'])
 @login_required
@@ -573,7 +940,11 @@ def upload_photo():
         )
         
         db.session.add(photo)
+        incrementer_versions(['photos'])
         db.session.commit()
+        # Orientation, réduction et variantes en arrière-plan : la réponse n'attend pas
+        pool_photos().submit(traiter_photo_en_fond, photo.id)
+        demarrer_collecte_stockage()
         
         # Log pour debug
         print(f"PHOTO ENREGISTREE: {{'site_id': {site_id}, 'site_nom': '{site_nom}', 'nom_debitmetre': '{nom_debitmetre}', 'utilisateur_id': {current_user.id}, 'date': {photo.date}, 'fichier_photo': '{filename}', 'session_id': '{session_id}'}}")
@@ -585,69 +956,30 @@ def upload_photo():
 
 @app.route('/api/releve_20_status')
 @login_required
+@reponse_en_cache(lambda: 'photos')
 def get_releve_20_status():
-    """Récupère le statut des relevés du 20 pour chaque site"""
+    """Récupère le statut des relevés du 20 pour chaque site : dernière photo du mois
+    par (site, débitmètre), en une requête ; en cache jusqu'au prochain upload"""
     try:
-        # Débitmètres à photographier par site
-        debitmetres_smp = [
-            'Exhaure 1', 'Exhaure 2', 'Exhaure 3', 'Exhaure 4', 
-            'Retour dessableur', 'Retour Orage'
-        ]
-        debitmetres_lpz = [
-            'Exhaure 1', 'Exhaure 2', 'Retour dessableur'
-        ]
-        
-        # Récupérer les sites
-        site_smp = Site.query.filter_by(nom='SMP').first()
-        site_lpz = Site.query.filter_by(nom='LPZ').first()
-        
-        # Fonction pour vérifier le statut d'un débitmètre
-        def get_debitmetre_status(site_id, nom_debitmetre):
-            # Vérifier s'il y a une photo pour ce débitmètre aujourd'hui
-            photo_aujourd_hui = PhotoReleve.query.filter_by(
-                site_id=site_id,
-                nom_debitmetre=nom_debitmetre,
-                date=datetime.now().date()
-            ).first()
-            
-            if photo_aujourd_hui:
+        today = datetime.now().date()
+        dernieres = dict(((site, nom), date_photo) for site, nom, date_photo in db.session.query(
+            Site.nom, PhotoReleve.nom_debitmetre, func.max(PhotoReleve.date)
+        ).join(
+            Site, Site.id == PhotoReleve.site_id
+        ).filter(
+            PhotoReleve.date >= today.replace(day=1)
+        ).group_by(Site.nom, PhotoReleve.nom_debitmetre))
+        
+        def statut(site, nom_debitmetre):
+            derniere = dernieres.get((site, nom_debitmetre))
+            if derniere == today:
                 return 'Terminé'
-            else:
-                # Vérifier s'il y a des photos récentes (ce mois)
-                debut_mois = datetime.now().replace(day=1).date()
-                photo_ce_mois = PhotoReleve.query.filter_by(
-                    site_id=site_id,
-                    nom_debitmetre=nom_debitmetre
-                ).filter(PhotoReleve.date >= debut_mois).first()
-                
-                if photo_ce_mois:
-                    return 'En cours'
-                else:
-                    return 'En attente'
-        
-        # Statut SMP
-        smp_status = []
-        if site_smp:
-            for debitmetre in debitmetres_smp:
-                smp_status.append({
-                    'nom': debitmetre,
-                    'statut': get_debitmetre_status(site_smp.id, debitmetre)
-                })
-        
-        # Statut LPZ
-        lpz_status = []
-        if site_lpz:
-            for debitmetre in debitmetres_lpz:
-                lpz_status.append({
-                    'nom': debitmetre,
-                    'statut': get_debitmetre_status(site_lpz.id, debitmetre)
-                })
+            return 'En cours' if derniere else 'En attente'
         
-        return jsonify({
-            'success': True,
-            'smp': smp_status,
-            'lpz': lpz_status
-        })
+        result = {'success': True}
+        for site, noms in debitmetres_releve_20().items():
+            result[site.lower()] = [{'nom': nom, 'statut': statut(site, nom)} for nom in noms]
+        return jsonify(result)
         
     except Exception as e:
         return jsonify({
@@ -661,64 +993,185 @@ def photos():
     photos = PhotoReleve.query.order_by(PhotoReleve.date.desc()).all()
     return render_template('photos.html', photos=photos)
 
+# Traitement des photos : pool de threads (Pillow libère le GIL pendant le décodage/encodage)
+PHOTO_DELAI_ABANDON = timedelta(minutes=10)  # une photo 'en_cours' depuis ce délai est retraitée
+_photos_etat = {'pool': None}
+_photos_lock = Lock()
+
+def pool_photos():
+    with _photos_lock:
+        if _photos_etat['pool'] is None:
+            _photos_etat['pool'] = ThreadPoolExecutor(max_workers=app.config['PHOTOS_WORKERS'], thread_name_prefix='photos')
+            # Photos restées en attente (redémarrage, photos d'avant le traitement)
+            abandon = datetime.utcnow() - PHOTO_DELAI_ABANDON
+            en_attente = db.session.query(PhotoReleve.id).outerjoin(
+                TraitementPhoto, TraitementPhoto.photo_id == PhotoReleve.id
+            ).filter(db.or_(
+                TraitementPhoto.photo_id.is_(None),
+                db.and_(TraitementPhoto.statut == 'en_cours', TraitementPhoto.updated_at < abandon)
+            ))
+            for (photo_id,) in en_attente:
+                _photos_etat['pool'].submit(traiter_photo_en_fond, photo_id)
+        return _photos_etat['pool']
+
+def reserver_photo(photo_id):
+    """Un seul worker traite une photo donnée : la ligne de traitement sert de réservation"""
+    try:
+        db.session.add(TraitementPhoto(photo_id=photo_id, statut='en_cours', updated_at=datetime.utcnow()))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+    # Déjà réservée : on ne la reprend que si le traitement a été abandonné (worker tué)
+    reprise = db.session.execute(
+        db.update(TraitementPhoto).where(
+            TraitementPhoto.photo_id == photo_id, TraitementPhoto.statut == 'en_cours',
+            TraitementPhoto.updated_at < datetime.utcnow() - PHOTO_DELAI_ABANDON
+        ).values(updated_at=datetime.utcnow())
+    ).rowcount == 1
+    db.session.commit()
+    return reprise
+
+def traiter_photo_en_fond(photo_id):
+    with app.app_context():
+        try:
+            if not reserver_photo(photo_id):
+                return
+            photo = db.session.get(PhotoReleve, photo_id)
+            if photo is None:
+                return
+            original = photo.fichier_photo
+            photo.fichier_photo = traiter_photo(app.config['UPLOAD_FOLDER'], original)
+            db.session.get(TraitementPhoto, photo_id).statut = 'termine'
+            db.session.commit()
+            if photo.fichier_photo != original:
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], original))
+        except Exception as e:
+            # Photo illisible par Pillow : l'original reste servi tel quel
+            db.session.rollback()
+            print(f"Erreur lors du traitement de la photo {photo_id}: {e}")
+            db.session.execute(db.update(TraitementPhoto).where(TraitementPhoto.photo_id == photo_id).values(statut='erreur'))
+            db.session.commit()
+
+def variante_photo(photo, statut, variante):
+    """Fichier de la variante (vignette, apercu), ou la photo elle-même tant qu'elle n'est pas traitée"""
+    if statut == 'termine':
+        return nom_variante(photo.fichier_photo, variante)
+    return photo.fichier_photo
+
+def supprimer_fichiers_photos(photos):
+    """Supprime les photos et leurs variantes du dossier d'upload, et leur état de traitement"""
+    for photo in photos:
+        for fichier in fichiers_photo(photo.fichier_photo):
+            try:
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], fichier)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except Exception as e:
+                print(f"Erreur suppression fichier {fichier}: {e}")
+    if photos:
+        TraitementPhoto.query.filter(TraitementPhoto.photo_id.in_([p.id for p in photos])).delete(synchronize_session=False)
+
+UPLOADS_CACHE_DUREE = 365 * 24 * 3600  # variantes de photo : jamais réécrites
+
 @app.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    """Fichier d'upload avec ETag fort, requêtes conditionnelles (304) et partielles (Range)"""
+    mode = app.config['UPLOADS_SENDFILE']
+    if mode in ('nginx', 'apache'):
+        chemin = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+        if chemin is None or not os.path.isfile(chemin):
+            abort(404)
+        # Le serveur frontal envoie le fichier (et gère lui-même ETag et Range)
+        reponse = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if mode == 'nginx':
+            # URI interne décodée par nginx : espaces, accents, '?' ou '#' doivent être encodés
+            reponse.headers['X-Accel-Redirect'] = app.config['UPLOADS_ACCEL_PREFIX'] + quote(filename)
+        else:
+            reponse.headers['X-Sendfile'] = chemin
+    else:
+        reponse = send_from_directory(
+            os.path.abspath(app.config['UPLOAD_FOLDER']), filename, conditional=True, etag=True
+        )
+    # Photos réservées aux utilisateurs connectés : cache du navigateur uniquement
+    reponse.cache_control.private = True
+    reponse.cache_control.public = False
+    if est_variante(filename):
+        reponse.cache_control.max_age = UPLOADS_CACHE_DUREE
+        reponse.cache_control.immutable = True
+        reponse.cache_control.no_cache = None
+    else:
+        # La photo conservée peut encore être remplacée par sa version traitée : revalidation (304)
+        reponse.cache_control.no_cache = True
+        reponse.cache_control.max_age = 0
+    return reponse
+
+RELEVES_20_LIMITE_DEFAUT = 50
+RELEVES_20_LIMITE_MAX = 200
 
 @app.route('/api/liste_releves_20')
 @login_required
 def liste_releves_20():
-    print("=== DIAGNOSTIC liste_releves_20 ===")
-    
-    # Récupérer toutes les photos, groupées par session_id (pas seulement aujourd'hui)
-    photos = PhotoReleve.query.order_by(PhotoReleve.date.desc()).all()
-    
-    # Grouper par session_id
-    sessions = {}
-    for photo in photos:
-        if photo.session_id not in sessions:
-            sessions[photo.session_id] = {
-                'date': photo.date,
-                'site_id': photo.site_id,
-                'utilisateur_id': photo.utilisateur_id,
-                'photos': []
-            }
-        sessions[photo.session_id]['photos'].append(photo)
-    
-    print(f"Résultat du groupement par session: {[(session_id, data['date'], data['site_id'], data['utilisateur_id'], len(data['photos'])) for session_id, data in sessions.items()]}")
-    
-    result = []
-    for session_id, data in sessions.items():
-        print(f"Traitement session: {session_id}, date={data['date']}, site_id={data['site_id']}, utilisateur_id={data['utilisateur_id']}, nb_photos={len(data['photos'])}")
-        
-        # Récupérer les informations du site et de l'utilisateur
-        # Gérer les deux formats : site_id comme entier ou comme chaîne
-        site = None
-        if isinstance(data['site_id'], int):
-            # Nouveau format : site_id est un entier
-            site = db.session.get(Site, data['site_id'])
-        else:
-            # Ancien format : site_id est une chaîne (nom du site)
-            site = Site.query.filter_by(nom=data['site_id']).first()
-        
-        user = db.session.get(User, data['utilisateur_id'])
-        
-        if site and user:
-            result.append({
-                'session_id': session_id,
-                'date': data['date'].strftime('%d/%m/%Y'),
-                'date_iso': data['date'].strftime('%Y-%m-%d'),
-                'site': site.nom,
-                'site_id': data['site_id'],
-                'utilisateur': user.username,
-                'utilisateur_id': data['utilisateur_id'],
-                'nb_photos': len(data['photos'])
-            })
-    
-    print(f"Relevés finaux: {result}")
-    print("=== FIN DIAGNOSTIC ===")
-    return jsonify(result)
+    """Sessions de photos du relevé du 20, les plus récentes d'abord, en une requête groupée.
+    Filtres : site (nom), mois (AAAA-MM) ; pagination par curseur (next_cursor)"""
+    site_nom = request.args.get('site')
+    mois = request.args.get('mois')
+    curseur = request.args.get('cursor')
+    limite = request.args.get('limit', RELEVES_20_LIMITE_DEFAUT, type=int)
+    limite = max(1, min(limite, RELEVES_20_LIMITE_MAX))
+    
+    sessions = db.session.query(
+        PhotoReleve.session_id.label('session_id'),
+        func.max(PhotoReleve.date).label('date'),
+        func.min(PhotoReleve.site_id).label('site_id'),
+        func.min(PhotoReleve.utilisateur_id).label('utilisateur_id'),
+        func.count(PhotoReleve.id).label('nb_photos')
+    )
+    if mois:
+        try:
+            debut_mois = datetime.strptime(mois, '%Y-%m').date()
+        except ValueError:
+            return jsonify({'error': 'Format de mois invalide (AAAA-MM)'}), 400
+        fin_mois = (debut_mois + timedelta(days=32)).replace(day=1)
+        sessions = sessions.filter(PhotoReleve.date >= debut_mois, PhotoReleve.date < fin_mois)
+    sessions = sessions.group_by(PhotoReleve.session_id).subquery()
+    
+    # Anciennes photos : site_id contient le nom du site au lieu de son id
+    query = db.session.query(sessions, Site.nom.label('site'), User.username.label('utilisateur')).join(
+        Site, db.or_(Site.id == sessions.c.site_id, Site.nom == db.cast(sessions.c.site_id, db.String))
+    ).join(User, User.id == sessions.c.utilisateur_id)
+    if site_nom:
+        query = query.filter(Site.nom == site_nom)
+    
+    # Curseur "AAAA-MM-JJ_session" : dernière session de la page précédente
+    if curseur:
+        try:
+            curseur_date, curseur_session = curseur.split('_', 1)
+            curseur_date = datetime.strptime(curseur_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'Curseur invalide'}), 400
+        query = query.filter(db.or_(
+            sessions.c.date < curseur_date,
+            db.and_(sessions.c.date == curseur_date, sessions.c.session_id < curseur_session)
+        ))
+    
+    lignes = query.order_by(sessions.c.date.desc(), sessions.c.session_id.desc()).limit(limite + 1).all()
+    page_suivante = len(lignes) > limite
+    lignes = lignes[:limite]
+    
+    result = [{
+        'session_id': ligne.session_id,
+        'date': ligne.date.strftime('%d/%m/%Y'),
+        'date_iso': ligne.date.strftime('%Y-%m-%d'),
+        'site': ligne.site,
+        'site_id': ligne.site_id,
+        'utilisateur': ligne.utilisateur,
+        'utilisateur_id': ligne.utilisateur_id,
+        'nb_photos': ligne.nb_photos
+    } for ligne in lignes]
+    next_cursor = f"{lignes[-1].date.isoformat()}_{lignes[-1].session_id}" if page_suivante else None
+    return jsonify({'releves': result, 'next_cursor': next_cursor})
 
 @app.route('/api/photos_releve_20')
 @login_required
@@ -727,13 +1180,17 @@ def photos_releve_20():
     if not session_id:
         return jsonify({'error': 'Paramètre session_id manquant'}), 400
     
-    photos = PhotoReleve.query.filter_by(session_id=session_id).all()
+    photos = db.session.query(PhotoReleve, TraitementPhoto.statut).outerjoin(
+        TraitementPhoto, TraitementPhoto.photo_id == PhotoReleve.id
+    ).filter(PhotoReleve.session_id == session_id).all()
     result = []
-    for p in photos:
+    for p, statut in photos:
         user = User.query.get(p.utilisateur_id)
         result.append({
             'nom_debitmetre': p.nom_debitmetre,
             'fichier_photo': p.fichier_photo,
+            'vignette': variante_photo(p, statut, 'vignette'),
+            'apercu': variante_photo(p, statut, 'apercu'),
             'commentaire': p.commentaire,
             'date': p.date.strftime('%d/%m/%Y'),
             'utilisateur': user.username if user else p.utilisateur_id
@@ -752,16 +1209,11 @@ def supprimer_releve_20():
         photos = PhotoReleve.query.filter_by(session_id=session_id).all()
         
         # Supprimer les fichiers physiques
-        for photo in photos:
-            try:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.fichier_photo)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                print(f"Erreur lors de la suppression du fichier {photo.fichier_photo}: {e}")
+        supprimer_fichiers_photos(photos)
         
         # Supprimer les enregistrements de la base
         PhotoReleve.query.filter_by(session_id=session_id).delete()
+        incrementer_versions(['photos'])
         db.session.commit()
         
         return jsonify({'success': True, 'message': f'Relevé supprimé avec succès ({len(photos)} photos)'})
@@ -773,17 +1225,10 @@ def supprimer_releve_20():
 @app.route('/api/veille_releve_20/<site_id>')
 @login_required
 def veille_releve_20(site_id):
-    # Récupérer la date d'hier
-    hier = datetime.now().date() - timedelta(days=1)
-    # Récupérer tous les types de relevé pour ce site
-    types = TypeReleve.query.filter_by(site_id=Site.query.filter_by(nom=site_id).first().id).all()
-    result = {}
-    for tr in types:
-        # On ne prend que les débitmètres (totalisateur)
-        if tr.type_mesure == 'totalisateur':
-            releve_hier = Releve.query.filter_by(type_releve_id=tr.id, date=hier).first()
-            result[tr.nom] = releve_hier.valeur if releve_hier else None
-    return jsonify(result)
+    # site_id est ici le nom du site (SMP, LPZ) ; les valeurs de la veille d'aujourd'hui
+    lignes = instantane_jour(site_id, datetime.now().date())
+    # On ne prend que les débitmètres (totalisateur)
+    return jsonify({l.nom: l.valeur_veille for l in lignes if l.type_mesure == 'totalisateur'})
 
 @app.route('/api/releves_jour/<int:site_id>')
 @login_required
@@ -795,59 +1240,274 @@ def api_releves_jour(site_id):
         date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
     except Exception:
         return jsonify({'error': 'Format de date invalide'}), 400
-    types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
+    lignes = instantane_jour(site_id, date_obj)
+    return jsonify({
+        l.id: {'valeur': l.valeur, 'unite': l.unite}
+        for l in lignes if l.releve_id is not None
+    })
+
+# Écriture groupée des relevés d'une journée
+def upsert_releves(date_obj, releves_data, utilisateur_id):
+    """Insère ou met à jour tous les relevés d'un formulaire en une seule requête
+    (INSERT ... ON CONFLICT DO UPDATE sur PostgreSQL comme sur SQLite)"""
+    # Un seul relevé par type : le dernier envoyé l'emporte
+    lignes = {}
+    maintenant = datetime.utcnow()
+    for releve_data in releves_data:
+        if not isinstance(releve_data, dict):
+            continue  # sécurité : ignorer si ce n'est pas un dict
+        type_releve_id = releve_data.get('type_releve_id')
+        valeur = releve_data.get('valeur')
+        if type_releve_id is None or valeur is None:
+            continue
+        lignes[type_releve_id] = {
+            'date': date_obj,
+            'type_releve_id': type_releve_id,
+            'valeur': valeur,
+            'commentaire': releve_data.get('commentaire', ''),
+            'utilisateur_id': utilisateur_id,
+            'created_at': maintenant
+        }
+    if not lignes:
+        return 0
+    
+    inserer_ou_maj(Releve.__table__, list(lignes.values()), ['type_releve_id', 'date'],
+                   ['valeur', 'commentaire', 'utilisateur_id'])
+    maj_consommations(date_obj, lignes.keys())
+    maj_completions_releves(date_obj, lignes.keys())
+    releves_modifies(lignes.keys())
+    return len(lignes)
+
+def inserer_ou_maj(table, lignes, cles, colonnes_maj):
+    """INSERT ... ON CONFLICT (cles) DO UPDATE en une requête, sur PostgreSQL comme sur SQLite"""
+    dialecte = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialecte == 'postgresql' else sqlite.insert
+    stmt = insert(table).values(lignes)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=cles,
+        set_={colonne: stmt.excluded[colonne] for colonne in colonnes_maj}
+    )
+    db.session.execute(stmt)
+
+# Débits journaliers des totalisateurs, maintenus de façon incrémentale
+def maj_consommations(date_obj, type_ids):
+    """Recalcule les deux débits touchés par l'écriture (ou la suppression) des relevés
+    de `type_ids` à `date_obj` : celui du jour et celui du relevé suivant"""
+    totalisateurs = [t for (t,) in db.session.query(TypeReleve.id).filter(
+        TypeReleve.id.in_(list(type_ids)), TypeReleve.type_mesure == 'totalisateur'
+    )]
+    if not totalisateurs:
+        return
+    
+    # Relevé du jour, relevé précédent et relevé suivant de chaque type, en une requête
+    colonnes = (Releve.type_releve_id, Releve.date, Releve.valeur)
+    du_jour = db.session.query(*colonnes).filter(
+        Releve.type_releve_id.in_(totalisateurs), Releve.date == date_obj
+    )
+    voisins = []
+    for agregat, condition in ((func.max, Releve.date < date_obj), (func.min, Releve.date > date_obj)):
+        dates = db.session.query(
+            Releve.type_releve_id.label('type_releve_id'), agregat(Releve.date).label('date')
+        ).filter(Releve.type_releve_id.in_(totalisateurs), condition).group_by(Releve.type_releve_id).subquery()
+        voisins.append(db.session.query(*colonnes).join(
+            dates, db.and_(Releve.type_releve_id == dates.c.type_releve_id, Releve.date == dates.c.date)
+        ))
+    precedents, jour, suivants = {}, {}, {}
+    for type_id, date, valeur in du_jour.union_all(*voisins).all():
+        cible = precedents if date < date_obj else (jour if date == date_obj else suivants)
+        cible[type_id] = (date, valeur)
+    
+    a_ecrire = []
+    a_supprimer = []
+    for type_id in totalisateurs:
+        precedent, courant, suivant = precedents.get(type_id), jour.get(type_id), suivants.get(type_id)
+        if courant and precedent:
+            a_ecrire.append({'type_releve_id': type_id, 'date': date_obj,
+                             'date_precedente': precedent[0], 'valeur': courant[1] - precedent[1]})
+        else:
+            a_supprimer.append((type_id, date_obj))
+        if suivant:
+            base = courant or precedent
+            if base:
+                a_ecrire.append({'type_releve_id': type_id, 'date': suivant[0],
+                                 'date_precedente': base[0], 'valeur': suivant[1] - base[1]})
+            else:
+                a_supprimer.append((type_id, suivant[0]))
+    
+    if a_supprimer:
+        ConsommationJournaliere.query.filter(db.or_(*[
+            db.and_(ConsommationJournaliere.type_releve_id == t, ConsommationJournaliere.date == d)
+            for t, d in a_supprimer
+        ])).delete(synchronize_session=False)
+    if a_ecrire:
+        inserer_ou_maj(ConsommationJournaliere.__table__, a_ecrire, ['type_releve_id', 'date'],
+                       ['date_precedente', 'valeur'])
+
+def rebuild_consommations():
+    """Recalcule toute la table des débits journaliers depuis l'historique des relevés"""
+    with db.engine.begin() as conn:
+        conn.execute(text('DELETE FROM consommation_journaliere'))
+        result = conn.execute(text("""
+            INSERT INTO consommation_journaliere (type_releve_id, date, date_precedente, valeur)
+            SELECT type_releve_id, date, date_precedente, valeur - valeur_precedente
+            FROM (
+                SELECT r.type_releve_id, r.date, r.valeur,
+                       LAG(r.date) OVER (PARTITION BY r.type_releve_id ORDER BY r.date) AS date_precedente,
+                       LAG(r.valeur) OVER (PARTITION BY r.type_releve_id ORDER BY r.date) AS valeur_precedente
+                FROM releve r
+                JOIN type_releve t ON t.id = r.type_releve_id
+                WHERE t.type_mesure = 'totalisateur'
+            ) deltas
+            WHERE date_precedente IS NOT NULL
+        """))
+    print(f"Débits journaliers recalculés : {result.rowcount} lignes")
+    return result.rowcount
+
+# Calendrier des saisies (tableau de bord), maintenu de façon incrémentale
+def marquer_completions(type_entite, date_obj, entite_ids, faits):
+    """Ajoute les jours `faits` et retire les autres parmi `entite_ids` (dans la transaction en cours)"""
+    absents = [e for e in entite_ids if e not in faits]
+    if absents:
+        CompletionJour.query.filter(
+            CompletionJour.type_entite == type_entite,
+            CompletionJour.entite_id.in_(absents),
+            CompletionJour.date == date_obj
+        ).delete(synchronize_session=False)
+    if faits:
+        dialecte = db.session.get_bind().dialect.name
+        insert = postgresql.insert if dialecte == 'postgresql' else sqlite.insert
+        db.session.execute(insert(CompletionJour.__table__).values([
+            {'type_entite': type_entite, 'entite_id': e, 'date': date_obj} for e in faits
+        ]).on_conflict_do_nothing(index_elements=['type_entite', 'entite_id', 'date']))
+
+def maj_completions_releves(date_obj, type_ids):
+    """Recalcule le jour `date_obj` des sites auxquels appartiennent ces types de relevé"""
+    sites = [site_id for (site_id,) in db.session.query(TypeReleve.site_id).filter(
+        TypeReleve.id.in_(list(type_ids))).distinct()]
+    if not sites:
+        return
+    faits = {site_id for (site_id,) in db.session.query(TypeReleve.site_id).join(Releve).filter(
+        TypeReleve.site_id.in_(sites), Releve.date == date_obj).distinct()}
+    marquer_completions('releve', date_obj, sites, faits)
+
+def maj_completions_routine(formulaire_id, date_obj):
+    formulaire_id = int(formulaire_id)
+    fait = db.session.query(ReponseRoutine.id).filter(
+        ReponseRoutine.formulaire_id == formulaire_id, ReponseRoutine.date_creation == date_obj
+    ).first() is not None
+    marquer_completions('routine', date_obj, [formulaire_id], {formulaire_id} if fait else set())
+
+def rebuild_completions():
+    """Recalcule tout le calendrier des saisies depuis les relevés et les réponses de routine"""
+    with db.engine.begin() as conn:
+        conn.execute(text('DELETE FROM completion_jour'))
+        result = conn.execute(text("""
+            INSERT INTO completion_jour (type_entite, entite_id, date)
+            SELECT DISTINCT 'releve', t.site_id, r.date
+            FROM releve r JOIN type_releve t ON t.id = r.type_releve_id
+            UNION
+            SELECT DISTINCT 'routine', formulaire_id, date_creation
+            FROM reponse_routine
+            WHERE date_creation IS NOT NULL
+        """))
+    print(f"Calendrier des saisies recalculé : {result.rowcount} lignes")
+    return result.rowcount
+
+def completions_accueil(resets, fenetre_jours=None):
+    """Statut du jour et régularité de tous les sites et routines, en une requête groupée.
+
+    Clés ('releve', nom du site) et ('routine', nom du formulaire). Sans fenêtre, la régularité
+    court depuis la première saisie ; avec fenêtre, sur les N derniers jours. Un reset
+    (clés ('releve', 'Relevé SMP') ou ('routine', nom)) fait repartir le calcul de sa date."""
+    today = datetime.now().date()
+    nom = case(
+        (CompletionJour.type_entite == 'releve', Site.nom),
+        else_=FormulaireRoutine.nom
+    )
+    debut_defaut = today - timedelta(days=fenetre_jours - 1) if fenetre_jours else datetime(1900, 1, 1).date()
+    debuts = []
+    for (type_entite, nom_reset), date_reset in resets.items():
+        if type_entite == 'releve':
+            nom_reset = nom_reset.replace('Relevé ', '', 1)
+        debuts.append((db.and_(CompletionJour.type_entite == type_entite, nom == nom_reset), date_reset))
+    debut = case(*debuts, else_=debut_defaut) if debuts else debut_defaut
+
+    lignes = db.session.query(
+        CompletionJour.type_entite, nom.label('nom'),
+        func.min(CompletionJour.date).label('premier'),
+        func.count(CompletionJour.id).label('jours_faits'),
+        func.max(case((CompletionJour.date == today, 1), else_=0)).label('fait')
+    ).outerjoin(
+        Site, db.and_(CompletionJour.type_entite == 'releve', Site.id == CompletionJour.entite_id)
+    ).outerjoin(
+        FormulaireRoutine, db.and_(CompletionJour.type_entite == 'routine', FormulaireRoutine.id == CompletionJour.entite_id)
+    ).filter(
+        CompletionJour.date >= debut, CompletionJour.date <= today
+    ).group_by(CompletionJour.type_entite, nom).all()
+
     result = {}
-    for tr in types_releve:
-        releve = Releve.query.filter_by(type_releve_id=tr.id, date=date_obj).first()
-        if releve:
-            result[tr.id] = {
-                'valeur': releve.valeur,
-                'unite': tr.unite
-            }
-    return jsonify(result)
+    for ligne in lignes:
+        cle_reset = ('releve', f'Relevé {ligne.nom}') if ligne.type_entite == 'releve' else ('routine', ligne.nom)
+        if fenetre_jours:
+            date_debut = resets.get(cle_reset) or debut_defaut
+        else:
+            date_debut = ligne.premier
+        jours = (today - date_debut).days + 1
+        result[(ligne.type_entite, ligne.nom)] = {
+            'fait': bool(ligne.fait),
+            'regularite': int(100 * ligne.jours_faits / jours) if jours > 0 else 0
+        }
+    return result
 
-# Nouvelles routes API pour les relevés SMP et LPZ
-@app.route('/api/releves_smp', methods=['GET', 'POST'])
+# Relevés d'un site : une seule route pour toutes les stations
+RELEVES_SITE_MAX_JOURS = 31
+
+def requete_releves_site(site_id, date_debut, date_fin):
+    """Types de relevé du site et relevés de la période en une seule requête (LEFT OUTER JOIN)"""
+    jointure = db.and_(
+        Releve.type_releve_id == TypeReleve.id,
+        Releve.date >= date_debut,
+        Releve.date <= date_fin
+    )
+    return db.session.query(
+        TypeReleve.id.label('id'),
+        TypeReleve.nom.label('nom'),
+        TypeReleve.type_mesure.label('type_mesure'),
+        TypeReleve.unite.label('unite'),
+        TypeReleve.frequence.label('frequence'),
+        TypeReleve.jour_specifique.label('jour_specifique'),
+        db.cast(Releve.date, db.String).label('date'),
+        Releve.valeur.label('valeur'),
+        func.coalesce(Releve.commentaire, '').label('commentaire'),
+        Releve.id.label('releve_id')
+    ).outerjoin(Releve, jointure).filter(
+        TypeReleve.site_id == site_id
+    ).order_by(TypeReleve.id, Releve.date)
+
+@app.route('/api/sites/<int:site_id>/releves', methods=['GET', 'POST'])
 @login_required
-def api_releves_smp() -> Union[Response, Tuple[Response, int]]:
+def api_site_releves(site_id) -> Union[Response, Tuple[Response, int]]:
     if request.method == 'GET':
+        # Soit une date, soit une période (date_debut/date_fin) pour précharger plusieurs jours
         date = request.args.get('date')
-        if not date:
+        date_debut = request.args.get('date_debut', date)
+        date_fin = request.args.get('date_fin', date)
+        if not date_debut or not date_fin:
             return jsonify({'error': 'Date requise'}), 400
         
         try:
-            date_obj = datetime.strptime(date, '%Y-%m-%d').date()
+            date_debut_obj = datetime.strptime(date_debut, '%Y-%m-%d').date()
+            date_fin_obj = datetime.strptime(date_fin, '%Y-%m-%d').date()
         except ValueError:
             return jsonify({'error': 'Format de date invalide'}), 400
+        if date_fin_obj < date_debut_obj:
+            return jsonify({'error': 'Période invalide'}), 400
+        if (date_fin_obj - date_debut_obj).days >= RELEVES_SITE_MAX_JOURS:
+            return jsonify({'error': f'Période trop longue ({RELEVES_SITE_MAX_JOURS} jours maximum)'}), 400
         
-        # Récupérer tous les types de relevé pour SMP
-        types_releve = TypeReleve.query.filter_by(site_id=1).order_by(TypeReleve.id).all()
-        
-        # Récupérer les relevés existants pour cette date
-        releves_existants = Releve.query.join(TypeReleve).filter(
-            TypeReleve.site_id == 1,
-            Releve.date == date_obj
-        ).all()
-        
-        # Créer un dictionnaire des relevés existants
-        releves_dict = {r.type_releve_id: r for r in releves_existants}
-        
-        result = []
-        for tr in types_releve:
-            releve = releves_dict.get(tr.id)
-            result.append({
-                'id': tr.id,
-                'nom': tr.nom,
-                'type_mesure': tr.type_mesure,
-                'unite': tr.unite,
-                'frequence': tr.frequence,
-                'jour_specifique': tr.jour_specifique,
-                'valeur': releve.valeur if releve else None,
-                'commentaire': releve.commentaire if releve else '',
-                'releve_id': releve.id if releve else None
-            })
-        
-        return jsonify(result)
+        # Une ligne par type (et par jour renseigné), déjà au format de la réponse
+        lignes = requete_releves_site(site_id, date_debut_obj, date_fin_obj).all()
+        return jsonify([dict(ligne._mapping) for ligne in lignes])
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -857,191 +1517,140 @@ def api_releves_smp() -> Union[Response, Tuple[Response, int]]:
             date_obj = datetime.strptime(data['date'], '%Y-%m-%d').date()
         except (KeyError, ValueError):
             return jsonify({'error': 'Date invalide'}), 400
-        # Traiter chaque relevé
-        for releve_data in data.get('releves', []):
-            if not isinstance(releve_data, dict):
-                continue  # sécurité : ignorer si ce n'est pas un dict
-            type_releve_id = releve_data.get('type_releve_id')
-            valeur = releve_data.get('valeur')
-            if type_releve_id is None or valeur is None:
-                continue
-            releve_existant = Releve.query.filter_by(
-                type_releve_id=type_releve_id,
-                date=date_obj
-            ).first()
-            if releve_existant:
-                releve_existant.valeur = valeur
-                releve_existant.commentaire = releve_data.get('commentaire', '')
-                releve_existant.utilisateur_id = current_user.id
-            else:
-                nouveau_releve = Releve(
-                    date=date_obj,
-                    type_releve_id=type_releve_id,
-                    valeur=valeur,
-                    commentaire=releve_data.get('commentaire', ''),
-                    utilisateur_id=current_user.id
-                )
-                db.session.add(nouveau_releve)
         try:
+            # Tous les relevés du formulaire en une seule requête
+            upsert_releves(date_obj, data.get('releves', []), current_user.id)
             db.session.commit()
-            backup_database()  # Sauvegarde automatique après sauvegarde SMP
+            backup_database()  # Sauvegarde automatique après saisie
             return jsonify({'success': True})
         except Exception as e:
             db.session.rollback()
             return jsonify({'error': f'Erreur lors de la sauvegarde: {str(e)}'}), 500
     return jsonify({'error': 'Méthode non supportée'}), 405
 
+# Anciennes routes SMP et LPZ, conservées pour compatibilité
+@app.route('/api/releves_smp', methods=['GET', 'POST'])
+@login_required
+def api_releves_smp() -> Union[Response, Tuple[Response, int]]:
+    return api_site_releves(1)
+
 @app.route('/api/releves_lpz', methods=['GET', 'POST'])
 @login_required
 def api_releves_lpz() -> Union[Response, Tuple[Response, int]]:
-    if request.method == 'GET':
-        date = request.args.get('date')
-        if not date:
-            return jsonify({'error': 'Date requise'}), 400
-        
-        try:
-            date_obj = datetime.strptime(date, '%Y-%m-%d').date()
-        except ValueError:
-            return jsonify({'error': 'Format de date invalide'}), 400
-        
-        # Récupérer tous les types de relevé pour LPZ
-        types_releve = TypeReleve.query.filter_by(site_id=2).order_by(TypeReleve.id).all()
-        
-        # Récupérer les relevés existants pour cette date
-        releves_existants = Releve.query.join(TypeReleve).filter(
-            TypeReleve.site_id == 2,
-            Releve.date == date_obj
-        ).all()
-        
-        # Créer un dictionnaire des relevés existants
-        releves_dict = {r.type_releve_id: r for r in releves_existants}
-        
-        result = []
-        for tr in types_releve:
-            releve = releves_dict.get(tr.id)
-            result.append({
-                'id': tr.id,
-                'nom': tr.nom,
-                'type_mesure': tr.type_mesure,
-                'unite': tr.unite,
-                'frequence': tr.frequence,
-                'jour_specifique': tr.jour_specifique,
-                'valeur': releve.valeur if releve else None,
-                'commentaire': releve.commentaire if releve else '',
-                'releve_id': releve.id if releve else None
-            })
-        
-        return jsonify(result)
-    
-    elif request.method == 'POST':
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'Données JSON requises'}), 400
-        try:
-            date_obj = datetime.strptime(data['date'], '%Y-%m-%d').date()
-        except (KeyError, ValueError):
-            return jsonify({'error': 'Date invalide'}), 400
-        for releve_data in data.get('releves', []):
-            if not isinstance(releve_data, dict):
-                continue
-            type_releve_id = releve_data.get('type_releve_id')
-            valeur = releve_data.get('valeur')
-            if type_releve_id is None or valeur is None:
-                continue
-            releve_existant = Releve.query.filter_by(
-                type_releve_id=type_releve_id,
-                date=date_obj
-            ).first()
-            if releve_existant:
-                releve_existant.valeur = valeur
-                releve_existant.commentaire = releve_data.get('commentaire', '')
-                releve_existant.utilisateur_id = current_user.id
-            else:
-                nouveau_releve = Releve(
-                    date=date_obj,
-                    type_releve_id=type_releve_id,
-                    valeur=valeur,
-                    commentaire=releve_data.get('commentaire', ''),
-                    utilisateur_id=current_user.id
-                )
-                db.session.add(nouveau_releve)
-        try:
-            db.session.commit()
-            backup_database()  # Sauvegarde automatique après sauvegarde LPZ
-            return jsonify({'success': True})
-        except Exception as e:
-            db.session.rollback()
-            return jsonify({'error': f'Erreur lors de la sauvegarde: {str(e)}'}), 500
-    return jsonify({'error': 'Méthode non supportée'}), 405
+    return api_site_releves(2)
+
+# Instantané d'une journée : valeurs du jour, de la veille et auteurs en une requête
+def instantane_jour(site, date_obj):
+    """Une ligne par type de relevé du site avec le relevé du jour, son auteur et la valeur de la veille.
+    `site` peut être l'id du site (entier) ou son nom (SMP, LPZ)"""
+    jour = aliased(Releve)
+    veille = aliased(Releve)
+    query = db.session.query(
+        TypeReleve.id.label('id'),
+        TypeReleve.nom.label('nom'),
+        TypeReleve.type_mesure.label('type_mesure'),
+        TypeReleve.unite.label('unite'),
+        TypeReleve.frequence.label('frequence'),
+        TypeReleve.jour_specifique.label('jour_specifique'),
+        jour.id.label('releve_id'),
+        jour.valeur.label('valeur'),
+        func.coalesce(jour.commentaire, '').label('commentaire'),
+        User.username.label('utilisateur'),
+        veille.valeur.label('valeur_veille')
+    ).outerjoin(
+        jour, db.and_(jour.type_releve_id == TypeReleve.id, jour.date == date_obj)
+    ).outerjoin(
+        User, User.id == jour.utilisateur_id
+    ).outerjoin(
+        veille, db.and_(veille.type_releve_id == TypeReleve.id, veille.date == date_obj - timedelta(days=1))
+    )
+    # Gérer les deux formats : id du site ou nom du site
+    if isinstance(site, int):
+        query = query.filter(TypeReleve.site_id == site)
+    else:
+        query = query.join(Site, Site.id == TypeReleve.site_id).filter(Site.nom == site)
+    return query.order_by(TypeReleve.id).all()
+
+def valeurs_veille(lignes):
+    """{nom: valeur de la veille} pour les types renseignés la veille"""
+    return {l.nom: l.valeur_veille for l in lignes if l.valeur_veille is not None}
+
+def releves_existants(lignes):
+    """Relevés déjà saisis pour la journée, avec leur auteur"""
+    return [{
+        'nom': l.nom,
+        'valeur': l.valeur,
+        'utilisateur': l.utilisateur or 'Inconnu'
+    } for l in lignes if l.releve_id is not None]
+
+def lire_date_param():
+    """Date passée en paramètre ?date=, ou une réponse d'erreur"""
+    date_str = request.args.get('date')
+    if not date_str:
+        return None, (jsonify({'error': 'Date requise'}), 400)
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%d').date(), None
+    except ValueError:
+        return None, (jsonify({'error': 'Format de date invalide'}), 400)
+
+@app.route('/api/sites/<int:site_id>/jour')
+@login_required
+def api_site_jour(site_id):
+    # Tout ce dont le formulaire de saisie a besoin pour une date, en une requête
+    date_releve, erreur = lire_date_param()
+    if erreur:
+        return erreur
+    lignes = instantane_jour(site_id, date_releve)
+    existants = releves_existants(lignes)
+    return jsonify({
+        'date': date_releve.strftime('%Y-%m-%d'),
+        'date_veille': (date_releve - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'existe': len(existants) > 0,
+        'releves_existants': existants,
+        'veille': valeurs_veille(lignes),
+        'types': [dict(l._mapping) for l in lignes]
+    })
 
 @app.route('/api/veille/<int:site_id>')
 @login_required
 def api_veille(site_id):
     # Récupérer les valeurs de la veille pour un site donné
-    date_str = request.args.get('date')
-    if not date_str:
-        return jsonify({'error': 'Date requise'}), 400
-    
-    date_releve = datetime.strptime(date_str, '%Y-%m-%d').date()
-    date_veille = date_releve - timedelta(days=1)
-    
-    # Récupérer tous les types de relevé pour ce site
-    types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
-    
-    # Récupérer les relevés de la veille
-    releves_veille = {}
-    for tr in types_releve:
-        releve = Releve.query.filter_by(
-            type_releve_id=tr.id,
-            date=date_veille
-        ).first()
-        if releve:
-            releves_veille[tr.nom] = releve.valeur
-    
+    date_releve, erreur = lire_date_param()
+    if erreur:
+        return erreur
+    lignes = instantane_jour(site_id, date_releve)
     return jsonify({
-        'date_veille': date_veille.strftime('%Y-%m-%d'),
-        'releves': releves_veille
+        'date_veille': (date_releve - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'releves': valeurs_veille(lignes)
     })
 
 @app.route('/api/verifier_existence/<int:site_id>')
 @login_required
 def api_verifier_existence(site_id):
     # Vérifier si des relevés existent déjà pour une date donnée
-    date_str = request.args.get('date')
-    if not date_str:
-        return jsonify({'error': 'Date requise'}), 400
-    
-    date_releve = datetime.strptime(date_str, '%Y-%m-%d').date()
-    
-    # Récupérer tous les types de relevé pour ce site
-    types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
-    
-    # Vérifier les relevés existants
-    releves_existants = []
-    for tr in types_releve:
-        releve = Releve.query.filter_by(
-            type_releve_id=tr.id,
-            date=date_releve
-        ).first()
-        if releve:
-            releves_existants.append({
-                'nom': tr.nom,
-                'valeur': releve.valeur,
-                'utilisateur': User.query.get(releve.utilisateur_id).username
-            })
-    
+    date_releve, erreur = lire_date_param()
+    if erreur:
+        return erreur
+    existants = releves_existants(instantane_jour(site_id, date_releve))
     return jsonify({
-        'date': date_str,
-        'existe': len(releves_existants) > 0,
-        'releves_existants': releves_existants
+        'date': date_releve.strftime('%Y-%m-%d'),
+        'existe': len(existants) > 0,
+        'releves_existants': existants
     })
 
 @app.route('/api/releve/<int:releve_id>', methods=['DELETE'])
 @login_required
 def supprimer_releve(releve_id):
     try:
-        releve = Releve.query.get_or_404(releve_id)
+        releve = db.session.get(Releve, releve_id)
+        if not releve:
+            return jsonify({'success': False, 'message': 'Relevé introuvable (supprimé ou archivé)'}), 404
+        type_releve_id, date_releve = releve.type_releve_id, releve.date
         db.session.delete(releve)
+        db.session.flush()
+        maj_consommations(date_releve, [type_releve_id])
+        maj_completions_releves(date_releve, [type_releve_id])
+        releves_modifies([type_releve_id])
         db.session.commit()
         return jsonify({'success': True, 'message': 'Relevé supprimé avec succès'})
     except Exception as e:
@@ -1058,7 +1667,13 @@ def supprimer_releves_jour(site_id):
         date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
         types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
         type_ids = [tr.id for tr in types_releve]
-        Releve.query.filter(Releve.type_releve_id.in_(type_ids), Releve.date == date_obj).delete(synchronize_session=False)
+        supprimes = Releve.query.filter(Releve.type_releve_id.in_(type_ids), Releve.date == date_obj).delete(synchronize_session=False)
+        if not supprimes and lit_archive(date_obj) and not archive_releves.lire([site_id], date_obj, date_obj).empty:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'Les relevés de cette journée sont archivés et ne peuvent plus être supprimés'}), 409
+        maj_consommations(date_obj, type_ids)
+        maj_completions_releves(date_obj, type_ids)
+        incrementer_versions([f'site:{site_id}', 'releves'])
         db.session.commit()
         return jsonify({'success': True, 'message': 'Tous les relevés de la journée ont été supprimés'})
     except Exception as e:
@@ -1067,29 +1682,96 @@ def supprimer_releves_jour(site_id):
 
 @app.route('/api/statistiques/<int:site_id>')
 @login_required
+@reponse_en_cache(lambda site_id: f'site:{site_id}')
 def get_statistiques(site_id):
-    jours = request.args.get('jours', 30, type=int)
-    date_debut = datetime.now().date() - timedelta(days=jours)
-    types_releve = TypeReleve.query.filter_by(site_id=site_id).all()
+    """Moyenne, min, max, total et nombre de valeurs par type, en une requête agrégée.
+    Paramètres : jours (30 par défaut) ou date_debut/date_fin, et periode=semaine|mois pour
+    découper par semaine ISO ou par mois. Les totalisateurs sont agrégés sur leurs débits journaliers"""
+    periode = request.args.get('periode')
+    if periode not in (None, 'semaine', 'mois'):
+        return jsonify({'error': 'Période invalide (semaine ou mois)'}), 400
+    try:
+        if request.args.get('date_debut'):
+            date_debut = datetime.strptime(request.args['date_debut'], '%Y-%m-%d').date()
+            date_fin = datetime.strptime(request.args.get('date_fin', datetime.now().date().isoformat()), '%Y-%m-%d').date()
+        else:
+            date_fin = datetime.now().date()
+            date_debut = date_fin - timedelta(days=request.args.get('jours', 30, type=int))
+    except ValueError:
+        return jsonify({'error': 'Format de date invalide'}), 400
+
+    if lit_archive(date_debut):
+        # Période au-delà de la fenêtre chaude : agrégation en pandas, archive comprise
+        lignes = statistiques_avec_archive(site_id, date_debut, date_fin, periode)
+    else:
+        def valeurs(modele, totalisateur):
+            query = db.session.query(
+                modele.type_releve_id.label('type_releve_id'), modele.date.label('date'), modele.valeur.label('valeur')
+            ).join(TypeReleve, modele.type_releve_id == TypeReleve.id).filter(
+                TypeReleve.site_id == site_id, modele.date >= date_debut, modele.date <= date_fin
+            )
+            if totalisateur:
+                return query.filter(TypeReleve.type_mesure == 'totalisateur')
+            return query.filter(TypeReleve.type_mesure != 'totalisateur')
+        donnees = valeurs(Releve, False).union_all(valeurs(ConsommationJournaliere, True)).subquery()
+
+        colonnes = [TypeReleve.id, TypeReleve.nom, TypeReleve.unite]
+        if periode:
+            colonnes.append(debut_periode(donnees.c.date, periode).label('debut_periode'))
+        lignes = db.session.query(
+            *colonnes,
+            func.avg(donnees.c.valeur).label('moyenne'),
+            func.min(donnees.c.valeur).label('min'),
+            func.max(donnees.c.valeur).label('max'),
+            func.sum(donnees.c.valeur).label('total'),
+            func.count(donnees.c.valeur).label('nombre')
+        ).join(TypeReleve, TypeReleve.id == donnees.c.type_releve_id).group_by(*colonnes).order_by(*colonnes).all()
+
     stats = []
-    for tr in types_releve:
-        releves = Releve.query.filter_by(type_releve_id=tr.id).filter(Releve.date >= date_debut).all()
-        if not releves:
-            continue
-        valeurs = [r.valeur for r in releves]
+    for ligne in lignes:
         stat = {
-            'nom': tr.nom,
-            'moyenne': sum(valeurs)/len(valeurs) if valeurs else 0,
-            'min': min(valeurs) if valeurs else 0,
-            'max': max(valeurs) if valeurs else 0,
-            'total': sum(valeurs) if valeurs else 0,
-            'unite': tr.unite
+            'type_releve_id': ligne.id,
+            'nom': ligne.nom,
+            'moyenne': float(ligne.moyenne),
+            'min': ligne.min,
+            'max': ligne.max,
+            'total': ligne.total,
+            'nombre': ligne.nombre,
+            'unite': ligne.unite
         }
+        if periode == 'semaine':
+            annee, semaine, _ = ligne.debut_periode.isocalendar()
+            stat['periode'] = f'S{semaine}-{annee}'
+        elif periode == 'mois':
+            stat['periode'] = ligne.debut_periode.strftime('%Y-%m')
         stats.append(stat)
     return jsonify(stats)
 
+def statistiques_avec_archive(site_id, date_debut, date_fin, periode):
+    """Mêmes lignes que l'agrégat SQL de get_statistiques, calculées sur table + archive"""
+    releves = charger_releves_indicateurs(date_debut, date_fin, site_ids=[site_id])
+    stats = statistiques_par_periode(releves, periode)
+    types = pd.DataFrame(
+        db.session.query(TypeReleve.id, TypeReleve.nom, TypeReleve.unite).filter_by(site_id=site_id).all(),
+        columns=['id', 'nom', 'unite']
+    )
+    stats = stats.rename(columns={'type_releve_id': 'id'}).astype({'id': 'int64'}).merge(types, on='id')
+    stats = stats.sort_values(['id', 'debut_periode'] if periode else ['id'])
+    return list(stats.astype(object).itertuples(index=False))
+
+def debut_periode(colonne, periode):
+    """Premier jour (lundi ou 1er du mois) de la semaine ou du mois de `colonne`, calculé en SQL"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return db.cast(func.date_trunc('week' if periode == 'semaine' else 'month', colonne), db.Date)
+    if periode == 'semaine':
+        # strftime('%w') : 0 = dimanche ; on recule jusqu'au lundi
+        decalage = db.cast((db.cast(func.strftime('%w', colonne), db.Integer) + 6) % 7, db.String)
+        return func.date(colonne, '-' + decalage + ' days', type_=db.Date)
+    return func.date(colonne, 'start of month', type_=db.Date)
+
 @app.route('/api/types_releve/<int:site_id>')
 @login_required
+@reponse_en_cache(lambda site_id: f'site:{site_id}')
 def api_types_releve(site_id):
     types = TypeReleve.query.filter_by(site_id=site_id).all()
     result = [
@@ -1107,161 +1789,103 @@ def api_types_releve(site_id):
 
 @app.route('/api/indicateurs_donnee/<int:type_releve_id>')
 @login_required
+@reponse_en_cache(portee_type_releve)
 def api_indicateurs_donnee(type_releve_id):
     jours = request.args.get('jours', 30, type=int)
     date_debut = datetime.now().date() - timedelta(days=jours)
     type_releve = TypeReleve.query.get_or_404(type_releve_id)
     try:
-        if type_releve.type_mesure == 'totalisateur':
-            releves = Releve.query.filter_by(type_releve_id=type_releve_id).filter(Releve.date >= date_debut).order_by(Releve.date).all()
-            valeurs = []
-            if len(releves) > 1:
-                for i in range(1, len(releves)):
-                    difference = releves[i].valeur - releves[i-1].valeur
-                    valeurs.append({
-                        'date': releves[i].date.strftime('%Y-%m-%d'),
-                        'valeur': difference
-                    })
-            print(f"[API indicateurs_donnee] type={type_releve.nom} valeurs={valeurs}")
-            return jsonify([{
-                'nom': type_releve.nom,
-                'unite': type_releve.unite,
-                'valeurs': valeurs
-            }])
-        elif type_releve.nom == 'Eau potable':
-            # Traitement spécial pour l'eau potable (hebdomadaire avec calcul de différence)
-            releves = Releve.query.filter_by(type_releve_id=type_releve_id).filter(Releve.date >= date_debut).order_by(Releve.date).all()
-            valeurs = []
-            if len(releves) > 1:
-                for i in range(1, len(releves)):
-                    difference = releves[i].valeur - releves[i-1].valeur
-                    # Calculer le numéro de semaine
-                    semaine = releves[i].date.isocalendar()
-                    semaine_label = f"S{semaine[1]}-{semaine[0]}"
-                    valeurs.append({
-                        'date': semaine_label,
-                        'valeur': difference
-                    })
-            print(f"[API indicateurs_donnee] Eau potable - valeurs={valeurs}")
-            return jsonify([{
-                'nom': type_releve.nom,
-                'unite': type_releve.unite,
-                'valeurs': valeurs
-            }])
-        elif type_releve.nom == 'Coagulant':
-            # Traitement spécial pour le coagulant (hebdomadaire sans calcul)
-            releves = Releve.query.filter_by(type_releve_id=type_releve_id).filter(Releve.date >= date_debut).order_by(Releve.date).all()
-            valeurs = []
-            for releve in releves:
-                # Calculer le numéro de semaine
-                semaine = releve.date.isocalendar()
-                semaine_label = f"S{semaine[1]}-{semaine[0]}"
-                valeurs.append({
-                    'date': semaine_label,
-                    'valeur': releve.valeur
-                })
-            print(f"[API indicateurs_donnee] Coagulant - valeurs={valeurs}")
-            return jsonify([{
-                'nom': type_releve.nom,
-                'unite': type_releve.unite,
-                'valeurs': valeurs
-            }])
-        else:
-            releves = Releve.query.filter_by(type_releve_id=type_releve_id).filter(Releve.date >= date_debut).order_by(Releve.date).all()
-            valeurs = [
-                {'date': r.date.strftime('%Y-%m-%d'), 'valeur': r.valeur}
-                for r in releves
-            ]
-            print(f"[API indicateurs_donnee] type={type_releve.nom} valeurs={valeurs}")
-            return jsonify([{
-                'nom': type_releve.nom,
-                'unite': type_releve.unite,
-                'valeurs': valeurs
-            }])
+        series = calculer_series(charger_releves_indicateurs(date_debut, type_releve_id=type_releve_id))
+        result = series_json(series)
+        if not result:
+            result = [{'nom': type_releve.nom, 'unite': type_releve.unite, 'valeurs': []}]
+        return jsonify(result)
     except Exception as e:
         print(f"[API indicateurs_donnee] ERREUR: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/rapport_pdf')
-@login_required
-def rapport_pdf():
-    # Récupérer les paramètres
-    date_debut = request.args.get('date_debut')
-    date_fin = request.args.get('date_fin')
-    sites_param = request.args.get('sites')  # ex: "SMP,LPZ"
-    if not date_debut or not date_fin or not sites_param:
-        return "Paramètres manquants", 400
+# Rendu des graphiques du rapport : pool de processus + cache disque par empreinte des données
+_graphiques_etat = {'pool': None}
+_graphiques_lock = Lock()
+
+def pool_graphiques():
+    """Pool de processus de rendu, créé au premier rapport.
+    Processus lancés par spawn : un fork depuis un worker multithreadé pourrait hériter
+    de verrous pris par d'autres threads (connexions, journalisation)"""
+    with _graphiques_lock:
+        if _graphiques_etat['pool'] is None:
+            _graphiques_etat['pool'] = ProcessPoolExecutor(
+                max_workers=app.config['GRAPHIQUES_WORKERS'], mp_context=multiprocessing.get_context('spawn')
+            )
+        return _graphiques_etat['pool']
+
+def generer_graphiques(data_series):
+    """Chemins des PNG des séries, dans l'ordre ; seuls les graphiques absents du cache sont rendus"""
+    cles = []
+    chemins = {}
+    a_rendre = {}
+    for serie in data_series:
+        # Toujours générer un graphique, même si pas de valeurs
+        args = (
+            f"{serie['nom']} - {serie['site']}",
+            serie['unite'],
+            [d.strftime('%d/%m/%Y') for d, v in serie['valeurs']],
+            [v for d, v in serie['valeurs']]
+        )
+        cle = cle_graphique(*args)
+        cles.append(cle)
+        if cle not in chemins and cle not in a_rendre:
+            chemin = cache_graphiques.chemin_si_present(cle)
+            if chemin is None:
+                a_rendre[cle] = args
+            else:
+                chemins[cle] = chemin
+    if not a_rendre:
+        return [chemins[cle] for cle in cles]
+    
     try:
-        date_debut_dt = datetime.strptime(date_debut, '%Y-%m-%d').date()
-        date_fin_dt = datetime.strptime(date_fin, '%Y-%m-%d').date()
-    except Exception:
-        return "Format de date invalide", 400
-    site_noms = sites_param.split(',')
-    sites = Site.query.filter(Site.nom.in_(site_noms)).all()
-    if not sites:
-        return "Aucun site trouvé", 400
+        pool = pool_graphiques()
+        futures = {cle: pool.submit(rendre_graphique, *args) for cle, args in a_rendre.items()}
+        rendus = {cle: future.result() for cle, future in futures.items()}
+    except Exception as e:
+        # Pool indisponible (processus interdits, pool cassé) : rendu dans ce processus
+        print(f"Rendu parallèle des graphiques impossible, rendu séquentiel: {e}")
+        with _graphiques_lock:
+            _graphiques_etat['pool'] = None
+        rendus = {cle: rendre_graphique(*args) for cle, args in a_rendre.items()}
+    
+    # Écriture atomique : un autre worker peut lire le même fichier au même moment
+    for cle, png in rendus.items():
+        chemins[cle] = cache_graphiques.ecrire(cle, png)
+    return [chemins[cle] for cle in cles]
+
+def generer_rapport_pdf(date_debut_dt, date_fin_dt, site_noms, progression=None):
+    """Contenu du rapport PDF (bytes) ; `progression(pourcentage)` est appelée à chaque étape"""
+    def avancer(pourcentage):
+        if progression:
+            progression(pourcentage)
 
-    # Récupérer tous les types de relevé pour les sites sélectionnés
-    types_releves = TypeReleve.query.filter(TypeReleve.site_id.in_([s.id for s in sites])).all()
+    sites = Site.query.filter(Site.nom.in_(site_noms)).all()
 
-    # Récupérer les données pour chaque type de relevé
+    # Toutes les séries des sites sélectionnés en une requête, calculs vectorisés
+    releves = charger_releves_indicateurs(date_debut_dt, date_fin_dt, site_ids=[s.id for s in sites])
+    series = dict(tuple(calculer_series(releves).groupby('type_releve_id')))
+    avancer(20)
+    
     data_series = []
-    for tr in types_releves:
-        releves = Releve.query.filter_by(type_releve_id=tr.id).filter(
-            Releve.date >= date_debut_dt, Releve.date <= date_fin_dt
-        ).order_by(Releve.date).all()
-        if not releves:
-            continue
-        
-        if tr.type_mesure == 'totalisateur' and len(releves) > 1:
-            valeurs = []
-            for i in range(1, len(releves)):
-                difference = releves[i].valeur - releves[i-1].valeur
-                valeurs.append((releves[i].date, difference))
-        elif tr.nom == 'Eau potable' and len(releves) > 1:
-            # Traitement spécial pour l'eau potable
-            valeurs = []
-            for i in range(1, len(releves)):
-                difference = releves[i].valeur - releves[i-1].valeur
-                valeurs.append((releves[i].date, difference))
-        elif tr.nom == 'Coagulant':
-            # Traitement spécial pour le coagulant
-            valeurs = [(r.date, r.valeur) for r in releves]
-        else:
-            valeurs = [(r.date, r.valeur) for r in releves]
-        
+    # Un graphique par type ayant au moins un relevé sur la période
+    for type_releve_id, infos in releves.groupby('type_releve_id', sort=True):
+        serie = series.get(type_releve_id, releves.iloc[0:0])
         data_series.append({
-            'nom': tr.nom,
-            'site': Site.query.get(tr.site_id).nom,
-            'unite': tr.unite,
-            'valeurs': valeurs
+            'nom': infos['nom'].iat[0],
+            'site': infos['site'].iat[0],
+            'unite': infos['unite'].iat[0],
+            'valeurs': list(zip(serie['date'].tolist(), serie['valeur'].tolist()))
         })
 
-    # Générer les graphiques avec matplotlib et les stocker en mémoire
-    images = []
-    for serie in data_series:
-        # Toujours générer un graphique, même si pas de valeurs
-        if serie['valeurs']:
-            dates = [d.strftime('%d/%m/%Y') for d, v in serie['valeurs']]
-            valeurs = [v for d, v in serie['valeurs']]
-        else:
-            dates = []
-            valeurs = []
-        plt.figure(figsize=(6,3))
-        if valeurs:
-            plt.plot(dates, valeurs, marker='o')
-        else:
-            plt.text(0.5, 0.5, 'Aucune donnée pour cette période', ha='center', va='center', fontsize=12, color='red', transform=plt.gca().transAxes)
-        plt.title(f"{serie['nom']} - {serie['site']}")
-        plt.xlabel('Date')
-        plt.ylabel(f"Valeur ({serie['unite']})")
-        plt.xticks(rotation=45, fontsize=7)
-        plt.tight_layout()
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        plt.close()
-        buf.seek(0)
-        images.append(buf.read())
+    # Graphiques : rendus en parallèle, ou relus depuis le cache s'ils existent déjà
+    images = generer_graphiques(data_series)
+    avancer(80)
 
     # Générer le PDF avec fpdf
     pdf = FPDF(orientation='P', unit='mm', format='A4')
@@ -1270,28 +1894,189 @@ def rapport_pdf():
     pdf.add_page()
     pdf.cell(0, 10, f"Rapport des relevés STE", ln=1, align='C')
     pdf.set_font('Arial', '', 12)
-    pdf.cell(0, 10, f"Période : {date_debut} au {date_fin}", ln=1, align='C')
+    pdf.cell(0, 10, f"Période : {date_debut_dt.isoformat()} au {date_fin_dt.isoformat()}", ln=1, align='C')
     pdf.cell(0, 10, f"Site(s) : {', '.join(site_noms)}", ln=1, align='C')
     pdf.ln(5)
     # 3 graphiques par page
-    for i, img in enumerate(images):
+    for i, img_path in enumerate(images):
         if i % 3 == 0 and i != 0:
             pdf.add_page()
-        # Sauvegarder l'image temporairement
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_img:
-            tmp_img.write(img)
-            tmp_img_path = tmp_img.name
-        pdf.image(tmp_img_path, x=15, y=pdf.get_y(), w=180)
+        # L'image en cache est lue directement (fpdf 1.7 ne lit que des fichiers)
+        pdf.image(img_path, x=15, y=pdf.get_y(), w=180)
         pdf.ln(65)
-        os.remove(tmp_img_path)
-    # Retourner le PDF
-    pdf_out = io.BytesIO()
     pdf_bytes = pdf.output(dest='S')
     if isinstance(pdf_bytes, str):
         pdf_bytes = pdf_bytes.encode('latin1')
-    pdf_out.write(pdf_bytes)
-    pdf_out.seek(0)
-    return send_file(pdf_out, mimetype='application/pdf', as_attachment=False, download_name='rapport_releves.pdf')
+    return pdf_bytes
+
+RAPPORT_DELAI_ABANDON = timedelta(minutes=15)  # une tâche 'en_cours' sans nouvelle depuis ce délai est reprise
+RAPPORT_CONSERVATION = timedelta(days=7)       # rapports générés conservés dans le cache
+_rapports_demande = Event()
+_rapports_lock = Lock()
+_rapports_etat = {'thread': None}
+
+def demarrer_worker_rapports():
+    """Démarre (une fois par processus) le thread qui génère les rapports en attente"""
+    with _rapports_lock:
+        if _rapports_etat['thread'] is None or not _rapports_etat['thread'].is_alive():
+            thread = Thread(target=boucle_rapports, name='rapports-pdf')
+            thread.daemon = True
+            thread.start()
+            _rapports_etat['thread'] = thread
+    _rapports_demande.set()
+
+def boucle_rapports(attente=5, continuer=lambda: True):
+    """Traite les tâches de la file ; sans tâche, attend une demande (ou `attente` secondes,
+    pour reprendre les tâches ajoutées par les autres workers)"""
+    while continuer():
+        _rapports_demande.clear()
+        try:
+            with app.app_context():
+                tache_id = reserver_tache_rapport()
+                if tache_id is not None:
+                    executer_tache_rapport(tache_id)
+                    continue
+                purger_taches_rapport()
+        except Exception as e:
+            print(f"Erreur dans la file des rapports: {e}")
+        _rapports_demande.wait(attente)
+
+def reserver_tache_rapport():
+    """Réserve la plus ancienne tâche à traiter ; la mise à jour conditionnelle
+    garantit qu'un seul worker la prend"""
+    abandon = datetime.utcnow() - RAPPORT_DELAI_ABANDON
+    a_traiter = db.or_(
+        TacheRapport.statut == 'en_attente',
+        db.and_(TacheRapport.statut == 'en_cours', TacheRapport.updated_at < abandon)
+    )
+    candidats = db.session.execute(
+        db.select(TacheRapport.id).where(a_traiter).order_by(TacheRapport.created_at, TacheRapport.id).limit(5)
+    ).scalars().all()
+    for tache_id in candidats:
+        resultat = db.session.execute(
+            db.update(TacheRapport)
+            .where(TacheRapport.id == tache_id, a_traiter)
+            .values(statut='en_cours', progression=0, message=None, updated_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if resultat.rowcount == 1:
+            return tache_id
+    return None
+
+def executer_tache_rapport(tache_id):
+    tache = db.session.get(TacheRapport, tache_id)
+    parametres = json.loads(tache.parametres)
+
+    def progression(pourcentage):
+        tache.progression = pourcentage
+        tache.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    try:
+        pdf_bytes = generer_rapport_pdf(
+            datetime.strptime(parametres['date_debut'], '%Y-%m-%d').date(),
+            datetime.strptime(parametres['date_fin'], '%Y-%m-%d').date(),
+            parametres['sites'], progression
+        )
+        tache.fichier = cache_rapports.ecrire(tache.cle, pdf_bytes)
+        tache.statut = 'termine'
+        tache.progression = 100
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erreur lors de la génération du rapport {tache_id}: {e}")
+        tache = db.session.get(TacheRapport, tache_id)
+        tache.statut = 'erreur'
+        tache.message = str(e)
+    tache.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def purger_taches_rapport():
+    """Supprime les tâches terminées trop anciennes et leurs fichiers"""
+    limite = datetime.utcnow() - RAPPORT_CONSERVATION
+    anciennes = TacheRapport.query.filter(
+        TacheRapport.statut.in_(['termine', 'erreur']), TacheRapport.updated_at < limite
+    ).all()
+    for tache in anciennes:
+        cache_rapports.supprimer(tache.cle)
+        db.session.delete(tache)
+    if anciennes:
+        db.session.commit()
+
+def tache_json(tache):
+    return {
+        'job_id': tache.id,
+        'statut': tache.statut,
+        'progression': tache.progression,
+        'message': tache.message
+    }
+
+@app.route('/rapport_pdf')
+@login_required
+def rapport_pdf():
+    """Met le rapport en file (ou reprend la tâche identique existante) et renvoie son identifiant"""
+    # Récupérer les paramètres
+    date_debut = request.args.get('date_debut')
+    date_fin = request.args.get('date_fin')
+    sites_param = request.args.get('sites')  # ex: "SMP,LPZ"
+    if not date_debut or not date_fin or not sites_param:
+        return jsonify({'error': 'Paramètres manquants'}), 400
+    try:
+        date_debut_dt = datetime.strptime(date_debut, '%Y-%m-%d').date()
+        date_fin_dt = datetime.strptime(date_fin, '%Y-%m-%d').date()
+    except Exception:
+        return jsonify({'error': 'Format de date invalide'}), 400
+    site_noms = sites_param.split(',')
+    sites = Site.query.filter(Site.nom.in_(site_noms)).order_by(Site.id).all()
+    if not sites:
+        return jsonify({'error': 'Aucun site trouvé'}), 400
+
+    # Même période, mêmes sites et données inchangées : même tâche (et même PDF)
+    parametres = json.dumps({'date_debut': date_debut_dt.isoformat(), 'date_fin': date_fin_dt.isoformat(), 'sites': site_noms})
+    versions = [f'site:{s.id}:{lire_version(f"site:{s.id}")}' for s in sites]
+    cle = cle_contenu(parametres, *versions)
+
+    dialecte = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialecte == 'postgresql' else sqlite.insert
+    db.session.execute(insert(TacheRapport.__table__).values(
+        cle=cle, parametres=parametres, statut='en_attente', progression=0,
+        created_at=datetime.utcnow(), updated_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=['cle']))
+    db.session.commit()
+    tache = TacheRapport.query.filter_by(cle=cle).first()
+
+    # Relancer une tâche en erreur, ou dont le PDF a été évincé du cache
+    if tache.statut == 'erreur' or (tache.statut == 'termine' and cache_rapports.chemin_si_present(tache.cle) is None):
+        db.session.execute(
+            db.update(TacheRapport)
+            .where(TacheRapport.id == tache.id, TacheRapport.statut == tache.statut)
+            .values(statut='en_attente', progression=0, message=None, fichier=None, updated_at=datetime.utcnow())
+        )
+        db.session.commit()
+        db.session.refresh(tache)
+
+    if tache.statut != 'termine':
+        demarrer_worker_rapports()
+    return jsonify(tache_json(tache)), 200 if tache.statut == 'termine' else 202
+
+@app.route('/api/rapport_pdf/<int:job_id>')
+@login_required
+def api_statut_rapport_pdf(job_id):
+    tache = db.session.get(TacheRapport, job_id)
+    if not tache:
+        return jsonify({'error': 'Tâche introuvable'}), 404
+    if tache.statut != 'termine':
+        # Après un redémarrage, la tâche doit retrouver un worker dans ce processus
+        demarrer_worker_rapports()
+    return jsonify(tache_json(tache))
+
+@app.route('/rapport_pdf/<int:job_id>/telecharger')
+@login_required
+def telecharger_rapport_pdf(job_id):
+    tache = db.session.get(TacheRapport, job_id)
+    chemin = cache_rapports.chemin_si_present(tache.cle) if tache and tache.statut == 'termine' else None
+    if chemin is None:
+        return "Rapport non disponible", 404
+    return send_file(os.path.abspath(chemin), mimetype='application/pdf', as_attachment=False, download_name='rapport_releves.pdf')
 
 @app.route('/attente_rapport_pdf')
 def attente_rapport_pdf():
@@ -1402,6 +2187,7 @@ def api_import_excel():
                     db.session.add(nouvelle_question)
                     inserted_count += 1
         
+        incrementer_versions(['routines'])
         db.session.commit()
         return jsonify({
             'message': 'Import réussi',
@@ -1435,6 +2221,9 @@ def api_sauvegarder_reponse():
     )
     
     db.session.add(nouvelle_reponse)
+    db.session.flush()
+    maj_completions_routine(nouvelle_reponse.formulaire_id, nouvelle_reponse.date_creation)
+    incrementer_versions(['routines'])
     db.session.commit()
     
     return jsonify({
@@ -1489,6 +2278,7 @@ def api_modifier_reponse(reponse_id):
     reponse.reponse = data.get('reponse', reponse.reponse)
     reponse.commentaire = data.get('commentaire', reponse.commentaire)
     reponse.utilisateur_id = current_user.id
+    incrementer_versions(['routines'])
     db.session.commit()
     return jsonify({'message': 'Réponse modifiée'})
 
@@ -1504,6 +2294,8 @@ def api_supprimer_reponse(reponse_id):
         return jsonify({'error': 'Suppression non autorisée'}), 403
     
     db.session.delete(reponse)
+    maj_completions_routine(reponse.formulaire_id, reponse.date_creation)
+    incrementer_versions(['routines'])
     db.session.commit()
     return jsonify({'message': 'Réponse supprimée'})
 
@@ -1623,6 +2415,7 @@ def api_export_excel_routines(date):
 
 @app.route('/api/routines/stats/<date>')
 @login_required
+@reponse_en_cache(lambda date: 'routines')
 def api_stats_routines(date):
     try:
         date_obj = datetime.strptime(date, '%Y-%m-%d').date()
@@ -1732,6 +2525,8 @@ def api_supprimer_routine_journee(formulaire_id, date):
         return jsonify({'error': 'Aucune réponse à supprimer'}), 404
     for rep in reponses:
         db.session.delete(rep)
+    maj_completions_routine(formulaire_id, date_obj)
+    incrementer_versions(['routines'])
     db.session.commit()
     return jsonify({'success': True})
 
@@ -1771,6 +2566,49 @@ def init_db():
         except Exception as e:
             print(f"Erreur lors de la vérification de la migration : {e}")
         
+        # Migration : index des photos (listes par session et par mois)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_photo_releve_session ON photo_releve (session_id)'))
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_photo_releve_date ON photo_releve (date)'))
+        except Exception as e:
+            print(f"Erreur lors de la création des index des photos : {e}")
+        
+        # Migration : dédoublonnage des relevés puis index unique (type_releve_id, date)
+        try:
+            inspector = db.inspect(db.engine)
+            index_releve = [idx['name'] for idx in inspector.get_indexes('releve')]
+            
+            if 'uq_releve_type_date' not in index_releve:
+                print("Migration : dédoublonnage des relevés (type, date)...")
+                with db.engine.begin() as conn:
+                    # On garde le relevé le plus récent (id le plus grand) de chaque couple
+                    result = conn.execute(text(
+                        'DELETE FROM releve WHERE id NOT IN '
+                        '(SELECT MAX(id) FROM releve GROUP BY type_releve_id, date)'
+                    ))
+                    conn.execute(text(
+                        'CREATE UNIQUE INDEX IF NOT EXISTS uq_releve_type_date '
+                        'ON releve (type_releve_id, date)'
+                    ))
+                print(f"Migration terminée : {result.rowcount} doublons supprimés")
+        except Exception as e:
+            print(f"Erreur lors de la migration des doublons de relevés : {e}")
+        
+        # Remplissage initial des débits journaliers des totalisateurs
+        try:
+            if not ConsommationJournaliere.query.first() and Releve.query.first():
+                rebuild_consommations()
+        except Exception as e:
+            print(f"Erreur lors du calcul initial des débits journaliers : {e}")
+        
+        # Calendrier des saisies du tableau de bord
+        try:
+            if not CompletionJour.query.first() and (Releve.query.first() or ReponseRoutine.query.first()):
+                rebuild_completions()
+        except Exception as e:
+            print(f"Erreur lors du calcul initial du calendrier des saisies : {e}")
+        
         # Créer les sites
         if not Site.query.first():
             smp = Site(nom='SMP', description='Station de traitement des eaux SMP')
@@ -2059,104 +2897,374 @@ def api_modifier_utilisateur(user_id):
     db.session.commit()
     return jsonify({'success': True})
 
-# Fonction de sauvegarde automatique de la base de données
+# Sauvegarde automatique de la base de données (SQLite uniquement)
+BACKUP_PREFIX = 'backup_ste_releve_'
+_backup_demande = Event()
+_backup_lock = Lock()
+_backup_etat = {'thread': None, 'db_path': None}
+
 def backup_database():
-    """Sauvegarde automatique de la base de données"""
+    """Demande une sauvegarde de la base : les écritures rapprochées sont regroupées
+    en une seule sauvegarde par fenêtre BACKUP_INTERVAL_SECONDS"""
+    # Sur PostgreSQL, Render gère les sauvegardes
+    if os.environ.get('DATABASE_URL'):
+        return
     try:
-        db_path = 'instance/ste_releve.db'
-        if os.path.exists(db_path):
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_path = f'instance/backup_ste_releve_{timestamp}.db'
-            shutil.copy2(db_path, backup_path)
-            print(f"Sauvegarde automatique créée: {backup_path}")
-            
-            # Garder seulement les 5 dernières sauvegardes
-            backup_dir = 'instance'
-            backup_files = [f for f in os.listdir(backup_dir) if f.startswith('backup_ste_releve_') and f.endswith('.db')]
-            backup_files.sort(reverse=True)
-            
-            for old_backup in backup_files[5:]:  # Garder seulement les 5 plus récentes
-                try:
-                    os.remove(os.path.join(backup_dir, old_backup))
-                    print(f"Ancienne sauvegarde supprimée: {old_backup}")
-                except Exception as e:
-                    print(f"Erreur lors de la suppression de {old_backup}: {e}")
+        db_path = db.engine.url.database
+        if not db_path or db_path == ':memory:':
+            return
+        with _backup_lock:
+            _backup_etat['db_path'] = db_path
+            if _backup_etat['thread'] is None or not _backup_etat['thread'].is_alive():
+                thread = Thread(target=_backup_worker, name='backup-sqlite')
+                thread.daemon = True
+                thread.start()
+                _backup_etat['thread'] = thread
+        _backup_demande.set()
     except Exception as e:
-        print(f"Erreur lors de la sauvegarde automatique: {e}")
+        print(f"Erreur lors de la demande de sauvegarde: {e}")
+
+def _backup_worker():
+    """Boucle de fond : attend une demande, laisse passer la rafale d'écritures puis sauvegarde"""
+    while True:
+        _backup_demande.wait()
+        time.sleep(app.config['BACKUP_INTERVAL_SECONDS'])
+        # Les écritures arrivées pendant la sauvegarde en redemanderont une autre
+        _backup_demande.clear()
+        try:
+            snapshot_sqlite_database(_backup_etat['db_path'])
+        except Exception as e:
+            print(f"Erreur lors de la sauvegarde automatique: {e}")
+
+def snapshot_sqlite_database(db_path):
+    """Copie cohérente de la base via l'API de sauvegarde en ligne de SQLite, compressée en gzip"""
+    if not db_path or not os.path.exists(db_path):
+        return None
+    backup_dir = os.path.dirname(os.path.abspath(db_path))
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_path = os.path.join(backup_dir, f'{BACKUP_PREFIX}{timestamp}.db.gz')
+    tmp_path = os.path.join(backup_dir, f'.{BACKUP_PREFIX}{timestamp}_{os.getpid()}.tmp')
+    
+    # Sauvegarde en ligne : ne bloque pas les écritures des autres connexions
+    source = sqlite3.connect(db_path)
+    destination = sqlite3.connect(tmp_path)
+    try:
+        source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
+    
+    try:
+        with open(tmp_path, 'rb') as f_in, gzip.open(backup_path + '.part', 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(backup_path + '.part', backup_path)
+    finally:
+        os.remove(tmp_path)
+    print(f"Sauvegarde automatique créée: {backup_path}")
+    
+    purge_old_backups(backup_dir, app.config['BACKUP_RETENTION'])
+    return backup_path
+
+def purge_old_backups(backup_dir, retention):
+    """Garde seulement les `retention` sauvegardes les plus récentes (.db et .db.gz)"""
+    backup_files = [f for f in os.listdir(backup_dir)
+                    if f.startswith(BACKUP_PREFIX) and (f.endswith('.db') or f.endswith('.db.gz'))]
+    backup_files.sort(reverse=True)  # le nom contient l'horodatage
+    
+    for old_backup in backup_files[retention:]:
+        try:
+            os.remove(os.path.join(backup_dir, old_backup))
+            print(f"Ancienne sauvegarde supprimée: {old_backup}")
+        except Exception as e:
+            print(f"Erreur lors de la suppression de {old_backup}: {e}")
+
+# Purge des données anciennes : par lots ordonnés par id, chaque lot validé séparément
+# (verrous d'écriture courts, mémoire bornée) ; une purge interrompue reprend au dernier lot
+PURGE_LOT = 500
+PURGE_FICHIERS_WORKERS = 4
+
+def _apres_purge_photos(photos):
+    TraitementPhoto.query.filter(TraitementPhoto.photo_id.in_([p.id for p in photos])).delete(synchronize_session=False)
+    incrementer_versions(['photos'])
+
+def _apres_purge_releves(releves):
+    """Archive le lot (avant sa suppression de la table) et invalide le cache des sites"""
+    sites = dict(db.session.query(TypeReleve.id, TypeReleve.site_id).filter(
+        TypeReleve.id.in_({r.type_releve_id for r in releves})
+    ).all())
+    lot = pd.DataFrame(
+        [(r.id, r.date, r.type_releve_id, r.valeur, r.commentaire, r.utilisateur_id, sites.get(r.type_releve_id)) for r in releves],
+        columns=['id', 'date', 'type_releve_id', 'valeur', 'commentaire', 'utilisateur_id', 'site_id']
+    )
+    for site_id, groupe in lot.dropna(subset=['site_id']).groupby('site_id'):
+        archive_releves.ajouter(int(site_id), groupe)
+    releves_modifies(set(sites))
+
+def etapes_purge():
+    """(étape, modèle, filtre(date_limite), conservation en jours, fichiers(lignes) ou None, après_lot(lignes))"""
+    return [
+        ('photos', PhotoReleve, lambda limite: PhotoReleve.date < limite, 730,
+         lambda photos: [f for photo in photos for f in fichiers_photo(photo.fichier_photo)],
+         _apres_purge_photos),
+        ('releves', Releve, lambda limite: Releve.date < limite, RELEVES_CONSERVATION_JOURS, None,
+         _apres_purge_releves),
+        ('consommations', ConsommationJournaliere, lambda limite: ConsommationJournaliere.date < limite,
+         RELEVES_CONSERVATION_JOURS, None,
+         lambda consommations: releves_modifies({c.type_releve_id for c in consommations})),
+        # ReponseRoutine ne mappe pas de colonne photo : pas de fichier à supprimer avec les réponses
+        ('routines', ReponseRoutine, lambda limite: ReponseRoutine.date_creation < limite, 1095, None,
+         lambda reponses: incrementer_versions(['routines'])),
+        ('completions_releves', CompletionJour,
+         lambda limite: db.and_(CompletionJour.type_entite == 'releve', CompletionJour.date < limite), 1825, None,
+         lambda completions: incrementer_versions(['releves'])),
+        ('completions_routines', CompletionJour,
+         lambda limite: db.and_(CompletionJour.type_entite == 'routine', CompletionJour.date < limite), 1095, None,
+         lambda completions: incrementer_versions(['routines'])),
+    ]
+
+def supprimer_fichier_upload(fichier):
+    """Supprime un fichier du dossier d'upload ; retourne le nombre d'octets libérés"""
+    chemin = os.path.join(app.config['UPLOAD_FOLDER'], fichier)
+    try:
+        taille = os.path.getsize(chemin)
+        os.remove(chemin)
+        return taille
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print(f"Erreur suppression fichier {fichier}: {e}")
+        return 0
+
+def point_reprise_purge(etape, jours):
+    """Point de reprise de l'étape : celui de la purge interrompue, ou un nouveau"""
+    point = db.session.get(PurgeDonnees, etape)
+    if point is None:
+        point = PurgeDonnees(etape=etape)
+        db.session.add(point)
+    if point.statut != 'en_cours' or point.date_limite is None:
+        point.date_limite = datetime.now().date() - timedelta(days=jours)
+        point.dernier_id = 0
+        point.lignes = 0
+        point.octets = 0
+        point.statut = 'en_cours'
+    point.updated_at = datetime.utcnow()
+    db.session.commit()
+    return point
+
+def purger_donnees(lot=PURGE_LOT):
+    """Supprime les données au-delà de leur durée de conservation, étape par étape.
+    Retourne {étape: {'lignes', 'octets'}} (octets : fichiers supprimés)"""
+    rapport = {}
+    with ThreadPoolExecutor(max_workers=PURGE_FICHIERS_WORKERS, thread_name_prefix='purge-fichiers') as pool:
+        for etape, modele, filtre, jours, fichiers, apres_lot in etapes_purge():
+            point = point_reprise_purge(etape, jours)
+            while True:
+                lignes = modele.query.filter(
+                    filtre(point.date_limite), modele.id > point.dernier_id
+                ).order_by(modele.id).limit(lot).all()
+                if not lignes:
+                    break
+                # Fichiers d'abord : si la purge est interrompue, les lignes restent et le lot est repris
+                if fichiers:
+                    point.octets += sum(pool.map(supprimer_fichier_upload, fichiers(lignes)))
+                ids = [ligne.id for ligne in lignes]
+                apres_lot(lignes)
+                modele.query.filter(modele.id.in_(ids)).delete(synchronize_session=False)
+                point.dernier_id = ids[-1]
+                point.lignes += len(ids)
+                point.updated_at = datetime.utcnow()
+                db.session.commit()
+                db.session.expunge_all()
+                point = db.session.get(PurgeDonnees, etape)
+            point.statut = 'termine'
+            point.updated_at = datetime.utcnow()
+            db.session.commit()
+            rapport[etape] = {'lignes': point.lignes, 'octets': point.octets}
+    return rapport
 
 # Fonction de nettoyage automatique de la base de données
 def cleanup_old_data():
-    """Nettoie automatiquement les anciennes données pour économiser l'espace"""
+    """Nettoie automatiquement les anciennes données pour économiser l'espace ;
+    retourne le rapport de purge (lignes et octets libérés par étape), ou None en cas d'erreur"""
     try:
         with app.app_context():
-            # Supprimer les photos de plus de 2 ans
-            two_years_ago = datetime.now().date() - timedelta(days=730)
-            old_photos = PhotoReleve.query.filter(PhotoReleve.date < two_years_ago).all()
-            
-            for photo in old_photos:
-                # Supprimer le fichier physique
-                try:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.fichier_photo)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    print(f"Erreur suppression fichier {photo.fichier_photo}: {e}")
-            
-            # Supprimer les enregistrements de la base
-            PhotoReleve.query.filter(PhotoReleve.date < two_years_ago).delete()
-            
-            # Supprimer les relevés de plus de 5 ans
-            five_years_ago = datetime.now().date() - timedelta(days=1825)
-            Releve.query.filter(Releve.date < five_years_ago).delete()
-            
-            # Supprimer les réponses de routine de plus de 3 ans
-            three_years_ago = datetime.now().date() - timedelta(days=1095)
-            ReponseRoutine.query.filter(ReponseRoutine.date_creation < three_years_ago).delete()
-            
-            db.session.commit()
-            
-            print(f"Nettoyage automatique effectué : {len(old_photos)} photos supprimées")
-            return True
+            rapport = purger_donnees()
+            lignes = sum(r['lignes'] for r in rapport.values())
+            octets = sum(r['octets'] for r in rapport.values())
+            print(f"Nettoyage automatique effectué : {lignes} lignes supprimées, {octets / (1024 * 1024):.2f} MB de fichiers libérés")
+            for etape, r in rapport.items():
+                if r['lignes']:
+                    print(f"   - {etape} : {r['lignes']} lignes, {r['octets'] / (1024 * 1024):.2f} MB")
+            return rapport
             
     except Exception as e:
         print(f"Erreur lors du nettoyage automatique: {e}")
+        db.session.rollback()
+        return None
+
+NETTOYAGE_DELAI_MIN = timedelta(hours=24)       # entre deux déclenchements automatiques
+NETTOYAGE_DELAI_ABANDON = timedelta(hours=6)    # exécution 'en_cours' depuis plus longtemps : worker tué
+
+def reserver_nettoyage(automatique=False):
+    """Réserve l'exécution du nettoyage pour ce worker ; la mise à jour conditionnelle
+    garantit qu'un seul worker la prend. Un déclenchement automatique exige en plus que le
+    nettoyage soit armé (voir check_database_size) et que le précédent date d'au moins
+    NETTOYAGE_DELAI_MIN"""
+    table = NettoyageAuto.__table__
+    dialecte = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialecte == 'postgresql' else sqlite.insert
+    db.session.execute(insert(table).values(id=1, statut='arme').on_conflict_do_nothing(index_elements=['id']))
+    maintenant = datetime.utcnow()
+    abandonne = db.and_(NettoyageAuto.statut == 'en_cours', NettoyageAuto.declenche_le < maintenant - NETTOYAGE_DELAI_ABANDON)
+    if automatique:
+        disponible = db.and_(
+            db.or_(NettoyageAuto.statut == 'arme', abandonne),
+            db.or_(NettoyageAuto.declenche_le.is_(None), NettoyageAuto.declenche_le < maintenant - NETTOYAGE_DELAI_MIN)
+        )
+    else:
+        disponible = db.or_(NettoyageAuto.statut != 'en_cours', abandonne)
+    resultat = db.session.execute(
+        db.update(NettoyageAuto).where(NettoyageAuto.id == 1, disponible)
+        .values(statut='en_cours', declenche_le=maintenant)
+    )
+    db.session.commit()
+    return resultat.rowcount == 1
+
+def terminer_nettoyage():
+    """Fin d'exécution : désarmé jusqu'à ce que l'espace utilisé repasse sous STOCKAGE_SEUIL_REARMEMENT"""
+    db.session.execute(
+        db.update(NettoyageAuto).where(NettoyageAuto.id == 1)
+        .values(statut='desarme', termine_le=datetime.utcnow())
+    )
+    db.session.commit()
+
+def lancer_nettoyage_en_fond(automatique=False):
+    """Lance cleanup_and_send_reports dans un thread ; False si un nettoyage est déjà en cours
+    (dans n'importe quel worker) ou, en automatique, s'il n'est pas armé"""
+    if not reserver_nettoyage(automatique):
         return False
 
+    def background_cleanup():
+        with app.app_context():
+            try:
+                cleanup_and_send_reports()
+            finally:
+                db.session.rollback()
+                terminer_nettoyage()
+
+    cleanup_thread = Thread(target=background_cleanup)
+    cleanup_thread.daemon = True
+    cleanup_thread.start()
+    return True
+
+# Mesure de l'espace utilisé : relue en arrière-plan, servie depuis le dernier instantané
+STOCKAGE_SEUIL_ALERTE = 0.8     # nettoyage automatique au-delà
+STOCKAGE_SEUIL_REARMEMENT = 0.7 # après un nettoyage, pas de nouveau déclenchement avant d'être repassé en dessous
+STOCKAGE_SEUIL_CRITIQUE = 0.9
+_stockage_parcours = ParcoursDossiers()
+_stockage_demande = Event()
+_stockage_lock = Lock()
+_stockage_etat = {'thread': None, 'instantane': None}
+
+def mesurer_stockage():
+    """Instantané de l'espace occupé : base (par table), photos, caches, sauvegardes"""
+    with db.engine.connect() as connexion:
+        base = taille_base(connexion)
+    dossiers = {
+        'uploads': _stockage_parcours.mesurer(os.path.abspath(app.config['UPLOAD_FOLDER'])),
+        'cache': _stockage_parcours.mesurer(os.path.abspath(app.config['CACHE_FOLDER'])),
+        'archives': _stockage_parcours.mesurer(os.path.abspath(app.config['ARCHIVES_FOLDER']))
+    }
+    sqlite_path = db.engine.url.database if db.engine.dialect.name == 'sqlite' else None
+    if sqlite_path and sqlite_path != ':memory:':
+        # Sauvegardes : à côté du fichier de la base (voir snapshot_sqlite_database)
+        dossiers['sauvegardes'] = _stockage_parcours.mesurer(os.path.dirname(os.path.abspath(sqlite_path)), BACKUP_PREFIX)
+    # Sur PostgreSQL, seule la base compte dans l'offre ; en SQLite tout est sur le même disque
+    utilise = base['taille']
+    if sqlite_path:
+        utilise += sum(octets for octets, _ in dossiers.values())
+    return {
+        'mesure_le': datetime.now(),
+        'utilise': utilise,
+        'base': base,
+        'dossiers': {nom: {'taille': octets, 'fichiers': fichiers} for nom, (octets, fichiers) in dossiers.items()},
+        'stats': {
+            'releves': db.session.query(func.count(Releve.id)).scalar(),
+            'photos': db.session.query(func.count(PhotoReleve.id)).scalar(),
+            'routines': db.session.query(func.count(ReponseRoutine.id)).scalar(),
+            'users': db.session.query(func.count(User.id)).scalar()
+        },
+        'caches': {
+            'graphiques': cache_graphiques.statistiques(),
+            'rapports': cache_rapports.statistiques()
+        }
+    }
+
+def rafraichir_stockage():
+    """Relit l'espace occupé, met l'instantané à jour et déclenche le nettoyage si nécessaire"""
+    instantane = mesurer_stockage()
+    _stockage_etat['instantane'] = instantane
+    check_database_size()
+    return instantane
+
+def demarrer_collecte_stockage():
+    """Démarre (une fois par processus) le thread qui mesure l'espace occupé"""
+    with _stockage_lock:
+        if _stockage_etat['thread'] is None or not _stockage_etat['thread'].is_alive():
+            thread = Thread(target=boucle_stockage, name='mesure-stockage')
+            thread.daemon = True
+            thread.start()
+            _stockage_etat['thread'] = thread
+
+def boucle_stockage(continuer=lambda: True):
+    while continuer():
+        _stockage_demande.clear()
+        try:
+            with app.app_context():
+                rafraichir_stockage()
+        except Exception as e:
+            print(f"Erreur lors de la mesure de l'espace utilisé: {e}")
+        _stockage_demande.wait(app.config['STOCKAGE_INTERVALLE_SECONDES'])
+
+def instantane_stockage():
+    """Dernier instantané ; mesuré sur place seulement au premier appel du processus"""
+    demarrer_collecte_stockage()
+    if _stockage_etat['instantane'] is None:
+        _stockage_etat['instantane'] = mesurer_stockage()
+    return _stockage_etat['instantane']
+
+def taux_stockage(instantane):
+    return instantane['utilise'] / (app.config['STOCKAGE_LIMITE_MO'] * 1024 * 1024)
+
 # Fonction pour vérifier l'espace utilisé
 def check_database_size():
-    """Vérifie la taille de la base de données"""
+    """Vérifie l'espace utilisé (dernier instantané) et lance le nettoyage s'il est proche de la limite"""
     try:
         with app.app_context():
-            # Compter les enregistrements
-            nb_releves = Releve.query.count()
-            nb_photos = PhotoReleve.query.count()
-            nb_routines = ReponseRoutine.query.count()
+            instantane = instantane_stockage()
+            utilise_mb = instantane['utilise'] / (1024 * 1024)
             
-            # Estimation de la taille (approximative)
-            estimated_size_mb = (nb_releves * 0.001) + (nb_photos * 2) + (nb_routines * 0.001)
+            print(f"📊 Espace utilisé : {utilise_mb:.2f} MB / {app.config['STOCKAGE_LIMITE_MO']} MB")
+            print(f"   - base : {instantane['base']['taille'] / (1024 * 1024):.2f} MB")
+            for nom, dossier in instantane['dossiers'].items():
+                print(f"   - {nom} : {dossier['taille'] / (1024 * 1024):.2f} MB ({dossier['fichiers']} fichiers)")
             
-            print(f"📊 Taille estimée de la base : {estimated_size_mb:.2f} MB")
-            print(f"   - {nb_releves} relevés")
-            print(f"   - {nb_photos} photos")
-            print(f"   - {nb_routines} réponses de routine")
-            
-            # Déclencher le nettoyage automatique si > 800MB
-            if estimated_size_mb > 800:
-                print("⚠️ ATTENTION : Base de données proche de la limite (1GB)")
-                print("🔄 Déclenchement du nettoyage automatique avec envoi de rapports...")
-                
-                # Lancer le nettoyage en arrière-plan
-                def background_cleanup():
-                    with app.app_context():
-                        cleanup_and_send_reports()
-                
-                cleanup_thread = Thread(target=background_cleanup)
-                cleanup_thread.daemon = True
-                cleanup_thread.start()
+            taux = taux_stockage(instantane)
+            if taux < STOCKAGE_SEUIL_REARMEMENT:
+                # Hystérésis : le nettoyage automatique est réarmé une fois l'espace redescendu
+                db.session.execute(
+                    db.update(NettoyageAuto).where(NettoyageAuto.id == 1, NettoyageAuto.statut == 'desarme')
+                    .values(statut='arme')
+                )
+                db.session.commit()
+            elif taux > STOCKAGE_SEUIL_ALERTE:
+                print(f"⚠️ ATTENTION : espace utilisé proche de la limite ({app.config['STOCKAGE_LIMITE_MO']} MB)")
                 
-                print("✅ Nettoyage automatique lancé en arrière-plan")
+                # Lancer le nettoyage en arrière-plan (un seul worker, s'il est armé)
+                if lancer_nettoyage_en_fond(automatique=True):
+                    print("🔄 Nettoyage automatique avec envoi de rapports lancé en arrière-plan")
             
-            return estimated_size_mb
+            return utilise_mb
             
     except Exception as e:
         print(f"Erreur lors de la vérification de la taille: {e}")
@@ -2165,42 +3273,41 @@ def check_database_size():
 @app.route('/api/database/status')
 @login_required
 def api_database_status():
-    """Retourne le statut de la base de données"""
+    """Retourne le statut de l'espace utilisé (dernier instantané, mesuré en arrière-plan)"""
     if current_user.role != 'admin':
         return jsonify({'error': 'Accès non autorisé'}), 403
     
     try:
-        # Compter les enregistrements
-        nb_releves = Releve.query.count()
-        nb_photos = PhotoReleve.query.count()
-        nb_routines = ReponseRoutine.query.count()
-        nb_users = User.query.count()
-        
-        # Estimation de la taille
-        estimated_size_mb = (nb_releves * 0.001) + (nb_photos * 2) + (nb_routines * 0.001)
+        instantane = instantane_stockage()
+        taux = taux_stockage(instantane)
         
         # Statut de l'espace
-        if estimated_size_mb > 900:
+        if taux > STOCKAGE_SEUIL_CRITIQUE:
             status = 'critical'
             message = 'Base de données presque pleine ! Upgrade recommandé.'
-        elif estimated_size_mb > 800:
+        elif taux > STOCKAGE_SEUIL_ALERTE:
             status = 'warning'
             message = 'Base de données proche de la limite.'
         else:
             status = 'ok'
             message = 'Espace suffisant.'
         
+        base = instantane['base']
         return jsonify({
             'status': status,
             'message': message,
-            'estimated_size_mb': round(estimated_size_mb, 2),
-            'usage_percent': round((estimated_size_mb / 1024) * 100, 1),
-            'stats': {
-                'releves': nb_releves,
-                'photos': nb_photos,
-                'routines': nb_routines,
-                'users': nb_users
-            }
+            'size_mb': round(instantane['utilise'] / (1024 * 1024), 2),
+            'limit_mb': app.config['STOCKAGE_LIMITE_MO'],
+            'usage_percent': round(taux * 100, 1),
+            'measured_at': instantane['mesure_le'].isoformat(timespec='seconds'),
+            'database': {
+                'size': base['taille'],
+                'free': base['libre'],
+                'tables': dict(sorted(base['tables'].items(), key=lambda t: -t[1]))
+            },
+            'folders': instantane['dossiers'],
+            'stats': instantane['stats'],
+            'caches': instantane['caches']
         })
         
     except Exception as e:
@@ -2213,14 +3320,9 @@ def api_database_cleanup():
     if current_user.role != 'admin':
         return jsonify({'error': 'Accès non autorisé'}), 403
     
-    try:
-        success = cleanup_and_send_reports()
-        if success:
-            return jsonify({'message': 'Nettoyage effectué avec succès'})
-        else:
-            return jsonify({'error': 'Erreur lors du nettoyage'}), 500
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    if not lancer_nettoyage_en_fond():
+        return jsonify({'message': 'Nettoyage déjà en cours'}), 202
+    return jsonify({'message': 'Nettoyage lancé en arrière-plan'}), 202
 
 @app.route('/api/email/config', methods=['GET', 'PUT'])
 @login_required
@@ -2280,16 +3382,31 @@ def api_test_email():
         <p><strong>Serveur SMTP:</strong> {config.smtp_server}:{config.smtp_port}</p>
         """
         
-        success = send_email_with_attachments(subject, body, [], config.email_address)
-        
-        if success:
-            return jsonify({'message': 'Email de test envoyé avec succès'})
-        else:
-            return jsonify({'error': 'Erreur lors de l\'envoi de l\'email de test'}), 500
+        message = mettre_en_file_email(subject, body, [], config.email_address)
+        db.session.commit()
+        demarrer_envoi_emails()
+        return jsonify({'message': 'Email de test mis en file d\'envoi', 'outbox_id': message.id}), 202
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/email/outbox/<int:outbox_id>')
+@login_required
+def api_email_outbox(outbox_id):
+    """Statut d'un email de la file d'envoi"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Accès non autorisé'}), 403
+    message = db.session.get(Outbox, outbox_id)
+    if message is None:
+        return jsonify({'error': 'Email introuvable'}), 404
+    demarrer_envoi_emails()
+    return jsonify({
+        'outbox_id': message.id,
+        'statut': message.statut,
+        'tentatives': message.tentatives,
+        'message': message.message
+    })
+
 # Modèle pour la configuration email
 class EmailConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -2311,87 +3428,240 @@ def get_email_config():
         db.session.commit()
     return config
 
-def send_email_with_attachments(subject, body, attachments, recipient_email):
-    """Envoie un email avec pièces jointes (ZIP/PDF/images)"""
+OUTBOX_LOT = 20                                 # emails envoyés sur une même connexion SMTP
+OUTBOX_TENTATIVES_MAX = 8                       # au-delà, l'email passe en 'erreur'
+OUTBOX_DELAI_MAX = timedelta(hours=1)           # attente maximale entre deux tentatives
+OUTBOX_DELAI_ABANDON = timedelta(minutes=15)    # un email 'en_cours' sans nouvelle depuis ce délai est repris
+OUTBOX_CONSERVATION = timedelta(days=30)        # emails envoyés conservés dans la table
+_outbox_demande = Event()
+_outbox_lock = Lock()
+_outbox_etat = {'thread': None}
+
+def mettre_en_file_email(subject, body, attachments, recipient_email, session_id=None, lot=None):
+    """Ajoute un email à la file d'envoi (dans la transaction en cours).
+    attachments : [{'path', 'filename', 'temporaire'}] ; les fichiers temporaires sont
+    supprimés une fois l'email envoyé (ou abandonné)"""
+    message = Outbox(
+        destinataire=recipient_email,
+        sujet=subject,
+        corps=body,
+        pieces_jointes=json.dumps([
+            {'path': a['path'], 'filename': a['filename'], 'temporaire': a.get('temporaire', False)}
+            for a in attachments
+        ]),
+        session_id=session_id,
+        lot=lot
+    )
+    db.session.add(message)
+    db.session.flush()
+    return message
+
+def demarrer_envoi_emails():
+    """Démarre (une fois par processus) le thread qui envoie les emails en attente"""
+    with _outbox_lock:
+        if _outbox_etat['thread'] is None or not _outbox_etat['thread'].is_alive():
+            thread = Thread(target=boucle_outbox, name='envoi-emails')
+            thread.daemon = True
+            thread.start()
+            _outbox_etat['thread'] = thread
+    _outbox_demande.set()
+
+def boucle_outbox(attente=30, continuer=lambda: True):
+    """Envoie les emails dus par lots ; sans email à envoyer, attend une demande
+    (ou `attente` secondes, pour les nouvelles tentatives et les emails des autres workers)"""
+    while continuer():
+        _outbox_demande.clear()
+        try:
+            with app.app_context():
+                ids = reserver_emails()
+                if ids:
+                    envoyer_lot_emails(ids)
+                    continue
+                purger_outbox()
+        except Exception as e:
+            print(f"Erreur dans la file d'envoi des emails: {e}")
+        _outbox_demande.wait(attente)
+
+def reserver_emails():
+    """Réserve jusqu'à OUTBOX_LOT emails dus ; la mise à jour conditionnelle
+    garantit qu'un seul worker envoie chaque email"""
+    maintenant = datetime.utcnow()
+    a_envoyer = db.or_(
+        db.and_(Outbox.statut == 'en_attente', Outbox.prochain_essai <= maintenant),
+        db.and_(Outbox.statut == 'en_cours', Outbox.updated_at < maintenant - OUTBOX_DELAI_ABANDON)
+    )
+    candidats = db.session.execute(
+        db.select(Outbox.id).where(a_envoyer).order_by(Outbox.prochain_essai, Outbox.id).limit(OUTBOX_LOT)
+    ).scalars().all()
+    reserves = []
+    for outbox_id in candidats:
+        resultat = db.session.execute(
+            db.update(Outbox).where(Outbox.id == outbox_id, a_envoyer).values(statut='en_cours', updated_at=maintenant)
+        )
+        if resultat.rowcount == 1:
+            reserves.append(outbox_id)
+    db.session.commit()
+    return reserves
+
+def connexion_smtp(config):
+    """Connexion SMTP authentifiée. STARTTLS dès que le serveur le propose ; sans
+    identifiants (relais local), pas d'authentification"""
+    server = smtplib.SMTP(config.smtp_server, config.smtp_port, timeout=60)
     try:
-        config = get_email_config()
-        
-        # Créer le message
-        msg = MIMEMultipart()
-        msg['From'] = config.smtp_username or 'noreply@ste-releve.com'
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-        
-        # Corps du message
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Ajouter les pièces jointes avec le bon type MIME
-        for attachment in attachments:
-            with open(attachment['path'], 'rb') as f:
-                filename = attachment['filename']
-                if filename.lower().endswith('.zip'):
-                    part = MIMEBase('application', 'zip')
-                elif filename.lower().endswith('.pdf'):
-                    part = MIMEBase('application', 'pdf')
-                elif filename.lower().endswith('.jpg') or filename.lower().endswith('.jpeg'):
-                    part = MIMEBase('image', 'jpeg')
-                elif filename.lower().endswith('.png'):
-                    part = MIMEBase('image', 'png')
-                else:
-                    part = MIMEBase('application', 'octet-stream')
-                part.set_payload(f.read())
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', f'attachment; filename="{filename}"')
-                msg.attach(part)
-        
-        # Envoyer l'email
-        if config.smtp_username and config.smtp_password:
-            server = smtplib.SMTP(config.smtp_server, config.smtp_port)
+        server.ehlo()
+        chiffre = server.has_extn('starttls')
+        if chiffre:
             server.starttls()
+            server.ehlo()
+        if config.smtp_username and config.smtp_password:
+            if not chiffre:
+                raise smtplib.SMTPNotSupportedError("STARTTLS non proposé : identifiants non envoyés en clair")
             server.login(config.smtp_username, config.smtp_password)
-            server.send_message(msg)
-            server.quit()
-            print(f"Email envoyé avec succès à {recipient_email}")
-            return True
-        else:
-            print("Configuration SMTP manquante")
-            return False
-            
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def envoyer_lot_emails(ids):
+    """Envoie les emails réservés sur une seule connexion SMTP (rouverte si le serveur la coupe)"""
+    config = get_email_config()
+    expediteur = config.smtp_username or 'noreply@ste-releve.com'
+    server = None
+    try:
+        for outbox_id in ids:
+            message = db.session.get(Outbox, outbox_id)
+            try:
+                if server is None:
+                    server = connexion_smtp(config)
+                with tempfile.NamedTemporaryFile(suffix='.eml') as fichier:
+                    ecrire_message(fichier, expediteur, message.destinataire, message.sujet, message.corps,
+                                   json.loads(message.pieces_jointes))
+                    fichier.flush()
+                    envoyer_message(server, expediteur, message.destinataire, fichier.name)
+            except Exception as e:
+                if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)) and server is not None:
+                    server.close()
+                    server = None
+                echec_email(message, e)
+                continue
+            message.statut = 'envoye'
+            message.message = None
+            message.updated_at = datetime.utcnow()
+            db.session.commit()
+            print(f"Email envoyé avec succès à {message.destinataire}")
+            apres_envoi_email(message)
+    finally:
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+def echec_email(message, erreur):
+    """Nouvelle tentative plus tard (délai doublé à chaque échec), ou abandon"""
+    print(f"Erreur lors de l'envoi d'email {message.id}: {erreur}")
+    message.tentatives += 1
+    message.message = str(erreur)
+    message.updated_at = datetime.utcnow()
+    if message.tentatives >= OUTBOX_TENTATIVES_MAX:
+        message.statut = 'erreur'
+        db.session.commit()
+        supprimer_pieces_jointes_temporaires(message)
+        return
+    delai = min(timedelta(minutes=2 ** (message.tentatives - 1)), OUTBOX_DELAI_MAX)
+    message.statut = 'en_attente'
+    message.prochain_essai = datetime.utcnow() + delai
+    db.session.commit()
+
+def supprimer_pieces_jointes_temporaires(message):
+    for attachment in json.loads(message.pieces_jointes):
+        if attachment.get('temporaire'):
+            try:
+                os.remove(attachment['path'])
+            except FileNotFoundError:
+                pass
+
+def apres_envoi_email(message):
+    """Une fois l'email envoyé : fichiers temporaires, et photos du relevé du 20
+    quand toutes les parties de son lot sont parties"""
+    supprimer_pieces_jointes_temporaires(message)
+    if not message.session_id:
+        return
+    restants = Outbox.query.filter(
+        Outbox.lot == message.lot, Outbox.statut != 'envoye'
+    ).count()
+    if restants:
+        return
+    try:
+        photos_to_delete = PhotoReleve.query.filter_by(session_id=message.session_id).all()
+        supprimer_fichiers_photos(photos_to_delete)
+        PhotoReleve.query.filter_by(session_id=message.session_id).delete()
+        incrementer_versions(['photos'])
+        db.session.commit()
+        print(f"✅ Relevé 20 {message.session_id} envoyé et supprimé")
     except Exception as e:
-        print(f"Erreur lors de l'envoi d'email: {e}")
-        return False
+        db.session.rollback()
+        print(f"Erreur suppression des photos du relevé 20 {message.session_id}: {e}")
+
+def purger_outbox():
+    """Supprime les emails envoyés ou abandonnés depuis longtemps"""
+    limite = datetime.utcnow() - OUTBOX_CONSERVATION
+    supprimes = Outbox.query.filter(
+        Outbox.statut.in_(['envoye', 'erreur']), Outbox.updated_at < limite
+    ).delete(synchronize_session=False)
+    if supprimes:
+        db.session.commit()
 
-def create_releve_20_zip(session_id):
-    """Crée un fichier ZIP avec toutes les photos d'un relevé du 20 (toujours, même s'il n'y en a qu'une)"""
+# Entrée ZIP : en-tête local + entrée du répertoire central, hors nom de fichier
+ZIP_SURCOUT_ENTREE = 128
+
+def create_releve_20_zips(session_id):
+    """Crée les fichiers ZIP des photos d'un relevé du 20 (toujours, même s'il n'y en a qu'une).
+    Les JPEG sont déjà compressés : ils sont stockés tels quels (ZIP_STORED), copiés par blocs.
+    Si le tout dépasse la taille d'un email, les photos sont réparties en plusieurs ZIP numérotés"""
     try:
         photos = PhotoReleve.query.filter_by(session_id=session_id).all()
         if not photos:
-            return None
+            return []
         
-        # Créer le ZIP
-        zip_filename = f"releve_20_{session_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for photo in photos:
-                photo_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.fichier_photo)
-                if os.path.exists(photo_path):
-                    # Nom du fichier dans le ZIP : nom_debitmetre/nom_photo.jpg
-                    arcname = f"{photo.nom_debitmetre}/{photo.fichier_photo}"
+        # Répartition des photos : chaque ZIP doit tenir dans un email une fois encodé
+        limite = taille_brute_max(app.config['MAIL_TAILLE_MAX_MO'] * 1024 * 1024)
+        groupes = [[]]
+        taille_groupe = 0
+        for photo in photos:
+            photo_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.fichier_photo)
+            if not os.path.exists(photo_path):
+                continue
+            # Nom du fichier dans le ZIP : nom_debitmetre/nom_photo.jpg
+            arcname = f"{photo.nom_debitmetre}/{photo.fichier_photo}"
+            taille = os.path.getsize(photo_path) + ZIP_SURCOUT_ENTREE + 2 * len(arcname.encode('utf-8'))
+            if groupes[-1] and taille_groupe + taille > limite:
+                groupes.append([])
+                taille_groupe = 0
+            groupes[-1].append((photo_path, arcname))
+            taille_groupe += taille
+        
+        base = f"releve_20_{session_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        zips = []
+        for numero, groupe in enumerate(groupes, 1):
+            zip_filename = f"{base}.zip" if len(groupes) == 1 else f"{base}_partie{numero}.zip"
+            zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
+            with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zipf:
+                for photo_path, arcname in groupe:
                     zipf.write(photo_path, arcname)
-        
-        # Vérification du contenu du ZIP (debug)
-        with zipfile.ZipFile(zip_path, 'r') as zipf:
-            print(f"Contenu du ZIP {zip_filename} : {zipf.namelist()}")
-        
-        return {
-            'path': zip_path,
-            'filename': zip_filename,
-            'photos_count': len(photos)
-        }
+            print(f"Contenu du ZIP {zip_filename} : {[arcname for _, arcname in groupe]}")
+            zips.append({
+                'path': zip_path,
+                'filename': zip_filename,
+                'photos_count': len(groupe),
+                'partie': numero,
+                'parties': len(groupes),
+                'lot': base
+            })
+        return zips
     except Exception as e:
         print(f"Erreur création ZIP relevé 20: {e}")
-        return None
+        return []
 
 def cleanup_and_send_reports():
     try:
@@ -2400,77 +3670,42 @@ def cleanup_and_send_reports():
             print("Aucune adresse email configurée")
             return False
         print("🔄 Début du nettoyage automatique avec envoi de rapports...")
-        # 1. Envoyer les relevés du 20 (inchangé)
-        sessions_photos = db.session.query(PhotoReleve.session_id).distinct().all()
+        # Mettre en file d'envoi les relevés du 20 (sauf ceux qui y sont déjà)
+        en_file = db.session.query(Outbox.session_id).filter(
+            Outbox.session_id.isnot(None), Outbox.statut.in_(['en_attente', 'en_cours'])
+        )
+        sessions_photos = db.session.query(PhotoReleve.session_id).filter(
+            PhotoReleve.session_id.notin_(en_file)
+        ).distinct().all()
         for (session_id,) in sessions_photos:
-            zip_file = create_releve_20_zip(session_id)
-            if zip_file:
+            zip_files = create_releve_20_zips(session_id)
+            if zip_files:
                 first_photo = PhotoReleve.query.filter_by(session_id=session_id).first()
                 if first_photo:
                     site = Site.query.get(first_photo.site_id)
                     user = User.query.get(first_photo.utilisateur_id)
-                    subject = f"Relevé du 20 - {site.nom if site else 'Site'} - {first_photo.date.strftime('%d/%m/%Y')}"
-                    body = f"""
-                    <h2>Relevé du 20 - {site.nom if site else 'Site'}</h2>
-                    <p><strong>Date:</strong> {first_photo.date.strftime('%d/%m/%Y')}</p>
-                    <p><strong>Utilisateur:</strong> {user.username if user else 'Inconnu'}</p>
-                    <p><strong>Nombre de photos:</strong> {zip_file['photos_count']}</p>
-                    <p>Ce fichier ZIP contient toutes les photos du relevé organisées par débitmètre.</p>
-                    """
-                    print(f"[CLEANUP] Envoi mail relevé 20: {subject}")
-                    success = send_email_with_attachments(subject, body, [zip_file], config.email_address)
-                    if success:
-                        print(f"[CLEANUP] Mail relevé 20 envoyé, suppression des photos...")
-                        photos_to_delete = PhotoReleve.query.filter_by(session_id=session_id).all()
-                        for photo in photos_to_delete:
-                            try:
-                                file_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.fichier_photo)
-                                if os.path.exists(file_path):
-                                    os.remove(file_path)
-                            except Exception as e:
-                                print(f"Erreur suppression fichier {photo.fichier_photo}: {e}")
-                        PhotoReleve.query.filter_by(session_id=session_id).delete()
-                        print(f"✅ Relevé 20 {session_id} envoyé et supprimé")
-                    try:
+                    for zip_file in zip_files:
+                        subject = f"Relevé du 20 - {site.nom if site else 'Site'} - {first_photo.date.strftime('%d/%m/%Y')}"
+                        if zip_file['parties'] > 1:
+                            subject += f" ({zip_file['partie']}/{zip_file['parties']})"
+                        body = f"""
+                        <h2>Relevé du 20 - {site.nom if site else 'Site'}</h2>
+                        <p><strong>Date:</strong> {first_photo.date.strftime('%d/%m/%Y')}</p>
+                        <p><strong>Utilisateur:</strong> {user.username if user else 'Inconnu'}</p>
+                        <p><strong>Nombre de photos:</strong> {zip_file['photos_count']}</p>
+                        <p>Ce fichier ZIP contient toutes les photos du relevé organisées par débitmètre.</p>
+                        """
+                        if zip_file['parties'] > 1:
+                            body += f"<p>Envoi {zip_file['partie']} sur {zip_file['parties']} : les photos sont réparties entre plusieurs emails.</p>"
+                        print(f"[CLEANUP] Mise en file du mail relevé 20: {subject}")
+                        # Les photos ne seront supprimées qu'une fois toutes les parties envoyées
+                        mettre_en_file_email(subject, body, [dict(zip_file, temporaire=True)], config.email_address,
+                                             session_id=session_id, lot=zip_file['lot'])
+                    db.session.commit()
+                else:
+                    for zip_file in zip_files:
                         os.remove(zip_file['path'])
-                    except:
-                        pass
-        # 2. Générer tous les PDF routines par formulaire rempli
-        pdfs = create_routine_pdfs_by_formulaire()
-        if pdfs:
-            subject = f"Rapports Routines STE avec Photos - {datetime.now().strftime('%d/%m/%Y')}"
-            body = f"""
-            <h2>Rapports Routines STE avec Photos</h2>
-            <p><strong>Date de génération:</strong> {datetime.now().strftime('%d/%m/%Y à %H:%M')}</p>
-            <p>Un PDF par formulaire rempli est joint à ce mail.</p>
-            """
-            print(f"[CLEANUP] Envoi mail routines avec {len(pdfs)} PDF en PJ...")
-            success = send_email_with_attachments(subject, body, pdfs, config.email_address)
-            if success:
-                print(f"[CLEANUP] Mail routines envoyé, suppression des photos routines...")
-        else:
-            print("[CLEANUP] Aucun PDF routine à envoyer, mais suppression des photos routines quand même...")
-        # Supprimer toutes les photos des routines (fichiers + champ photo_path) dans tous les cas
-        routines_photos = ReponseRoutine.query.filter(ReponseRoutine.photo_path.isnot(None)).all()
-        for rep in routines_photos:
-            if rep.photo_path:
-                try:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], rep.photo_path)
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        print(f"[CLEANUP] Photo routine supprimée: {file_path}")
-                except Exception as e:
-                    print(f"Erreur suppression photo routine {rep.photo_path}: {e}")
-            rep.photo_path = None
-        print("✅ Toutes les photos des routines supprimées, réponses conservées")
-        # Nettoyer les PDF temporaires
-        for pdf in pdfs:
-            try:
-                os.remove(pdf['path'])
-                print(f"[CLEANUP] PDF temporaire supprimé: {pdf['path']}")
-            except:
-                pass
-        db.session.commit()
+        demarrer_envoi_emails()
         print("✅ Nettoyage automatique terminé avec succès")
         return True
     except Exception as e:
@@ -2478,87 +3713,94 @@ def cleanup_and_send_reports():
         db.session.rollback()
         return False
 
+PISCINE_M3 = 2500  # volume d'une piscine olympique
+TYPES_RETOUR = ['Retour Orage', 'Retour dessableur']
+
+def volumes_exhaure_jour(date_obj):
+    """Volume du jour par site, en une requête : exhaures seules, et exhaures + retours
+    (orage, dessableur). Les exhaures sont des totalisateurs : on somme leurs débits journaliers"""
+    exhaure = TypeReleve.nom.like('Exhaure%')
+    retour = TypeReleve.nom.in_(TYPES_RETOUR)
+    debit = ConsommationJournaliere.valeur
+    return db.session.query(
+        Site.nom,
+        func.coalesce(func.sum(case((exhaure, debit), else_=0)), 0).label('exhaure'),
+        func.coalesce(func.sum(debit), 0).label('total')
+    ).outerjoin(
+        TypeReleve, db.and_(TypeReleve.site_id == Site.id, db.or_(exhaure, retour))
+    ).outerjoin(
+        ConsommationJournaliere, db.and_(
+            ConsommationJournaliere.type_releve_id == TypeReleve.id,
+            ConsommationJournaliere.date == date_obj
+        )
+    ).group_by(Site.id, Site.nom).order_by(Site.id).all()
+
+def volume_json(nom, m3):
+    return {'nom': nom, 'm3': int(m3), 'piscines': round(m3 / PISCINE_M3, 2)}
+
 @app.route('/api/accueil/synthese')
 @login_required
+@reponse_en_cache(lambda: ['releves', 'routines'])
 def api_accueil_synthese():
-    today = datetime.now().date()
-    # Relevé SMP
-    smp_fait = db.session.query(Releve).filter(Releve.site == 'SMP', Releve.date == today).count() > 0
-    # Relevé LPZ
-    lpz_fait = db.session.query(Releve).filter(Releve.site == 'LPZ', Releve.date == today).count() > 0
+    completions = completions_accueil({}, 1)
     # Routines (tous les formulaires)
-    routines = []
-    formulaires = FormulaireRoutine.query.order_by(FormulaireRoutine.nom).all()
-    for f in formulaires:
-        fait = db.session.query(ReponseRoutine).filter(ReponseRoutine.formulaire_id == f.id, ReponseRoutine.date_creation == today).count() > 0
-        routines.append({'nom': f.nom, 'fait': fait})
-    return jsonify({'smp': smp_fait, 'lpz': lpz_fait, 'routines': routines})
+    routines = [
+        {'nom': nom, 'fait': ('routine', nom) in completions}
+        for (nom,) in db.session.query(FormulaireRoutine.nom).order_by(FormulaireRoutine.nom)
+    ]
+    return jsonify({
+        'smp': ('releve', 'SMP') in completions,
+        'lpz': ('releve', 'LPZ') in completions,
+        'routines': routines
+    })
 
 @app.route('/api/accueil/exhaure')
 @login_required
+@reponse_en_cache(lambda: 'releves')
 def api_accueil_exhaure():
-    today = datetime.now().date()
-    # On suppose que le type de relevé exhaure est 'Exhaure' et qu'il y a un champ valeur, site
-    sites = ['SMP', 'LPZ']
-    result = []
-    for site in sites:
-        total = db.session.query(func.sum(Releve.valeur)).filter(Releve.site == site, Releve.type == 'Exhaure', Releve.date == today).scalar() or 0
-        piscines = round(total / 2500, 2)
-        result.append({'nom': site, 'm3': int(total), 'piscines': piscines})
-    return jsonify(result)
-
-# Stockage simple des dates de reset régularité (en mémoire, à remplacer par table si besoin)
-RESET_REGULARITE = {}
+    return jsonify([volume_json(ligne.nom, ligne.exhaure) for ligne in volumes_exhaure_jour(datetime.now().date())])
+
+# Dates de reset de la régularité : table partagée par tous les workers,
+# relue seulement quand la version 'regularite' change
+_resets_regularite = {'version': None, 'resets': {}}
+_resets_regularite_lock = Lock()
+
+def lire_resets_regularite():
+    """{(type, nom): date} des resets, depuis le cache du processus s'il est à jour"""
+    version = lire_version('regularite')
+    with _resets_regularite_lock:
+        if _resets_regularite['version'] == version:
+            return _resets_regularite['resets']
+    resets = {(r.type_entite, r.nom): r.date_reset for r in ResetRegularite.query.all()}
+    with _resets_regularite_lock:
+        _resets_regularite['version'] = version
+        _resets_regularite['resets'] = resets
+    return resets
 
 @app.route('/api/accueil/synthese_v2')
 @login_required
+@reponse_en_cache(lambda: ['releves', 'routines', 'regularite'])
 def api_accueil_synthese_v2():
-    today = datetime.now().date()
-    # Relevés fixes
-    releves = []
-    for nom in ['Relevé SMP', 'Relevé LPZ']:
-        site = 'SMP' if 'SMP' in nom else 'LPZ'
-        fait = db.session.query(Releve).filter(Releve.site == site, Releve.date == today).count() > 0
-        # Calcul régularité sur 30 jours (hors reset)
-        reset = RESET_REGULARITE.get(('releve', nom))
-        date_debut = reset if reset else (today - timedelta(days=29))
-        total = db.session.query(Releve.date).filter(Releve.site == site, Releve.date >= date_debut).distinct().count()
-        jours = (today - date_debut).days + 1
-        regularite = int(100 * total / jours) if jours > 0 else 0
-        releves.append({'nom': nom, 'fait': fait, 'regularite': regularite})
+    # Régularité sur 30 jours (ou depuis le reset), tous sites et routines en une requête
+    completions = completions_accueil(lire_resets_regularite(), 30)
+    absent = {'fait': False, 'regularite': 0}
+    releves = [
+        {'nom': f'Relevé {site}', **completions.get(('releve', site), absent)}
+        for site in ['SMP', 'LPZ']
+    ]
     # Routines fixes
     routines_noms = [
         'STE PRINCIPALE SMP', 'STE CAB SMP', 'STEP SMP',
         'STE PRINCIPALE LPZ', 'STE CAB LPZ', 'STEP LPZ'
     ]
-    routines = []
-    for nom in routines_noms:
-        formulaire = FormulaireRoutine.query.filter_by(nom=nom).first()
-        fait = False
-        regularite = 0
-        if formulaire:
-            fait = db.session.query(ReponseRoutine).filter(ReponseRoutine.formulaire_id == formulaire.id, ReponseRoutine.date_creation == today).count() > 0
-            reset = RESET_REGULARITE.get(('routine', nom))
-            date_debut = reset if reset else (today - timedelta(days=29))
-            jours = (today - date_debut).days + 1
-            total = db.session.query(ReponseRoutine.date_creation).filter(ReponseRoutine.formulaire_id == formulaire.id, ReponseRoutine.date_creation >= date_debut).distinct().count()
-            regularite = int(100 * total / jours) if jours > 0 else 0
-        routines.append({'nom': nom, 'fait': fait, 'regularite': regularite})
+    routines = [{'nom': nom, **completions.get(('routine', nom), absent)} for nom in routines_noms]
     return jsonify({'releves': releves, 'routines': routines})
 
 @app.route('/api/accueil/exhaure_v2')
 @login_required
+@reponse_en_cache(lambda: 'releves')
 def api_accueil_exhaure_v2():
-    today = datetime.now().date()
-    sites = ['SMP', 'LPZ']
-    result = []
-    for site in sites:
-        total = 0
-        for type_ in ['Exhaure', 'Bassin d\'orage', 'Retour dessableur']:
-            total += db.session.query(func.sum(Releve.valeur)).filter(Releve.site == site, Releve.type == type_, Releve.date == today).scalar() or 0
-        piscines = round(total / 2500, 2)
-        result.append({'nom': site, 'm3': int(total), 'piscines': piscines})
-    return jsonify(result)
+    return jsonify([volume_json(ligne.nom, ligne.total) for ligne in volumes_exhaure_jour(datetime.now().date())])
 
 @app.route('/api/accueil/reset_regularite', methods=['POST'])
 @login_required
@@ -2568,7 +3810,10 @@ def api_accueil_reset_regularite():
     nom = data.get('nom')
     if not type_ or not nom:
         return jsonify({'error': 'Paramètres manquants'}), 400
-    RESET_REGULARITE[(type_, nom)] = datetime.now().date()
+    inserer_ou_maj(ResetRegularite.__table__, [{'type_entite': type_, 'nom': nom, 'date_reset': datetime.now().date()}],
+                   ['type_entite', 'nom'], ['date_reset'])
+    incrementer_versions(['regularite'])
+    db.session.commit()
     return jsonify({'success': True})
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+"""
+Archive des relevés au-delà de la durée de conservation
+
+Les relevés retirés de la table sont écrits en CSV compressé (gzip), un fichier par site
+et par année : <dossier>/site_<id>/releves_<année>.csv.gz. Une partition est réécrite en
+entier (fusion avec son contenu, écriture atomique) et les doublons d'id sont éliminés :
+l'archivage d'un lot peut être rejoué sans risque. Les lectures ne chargent que les
+partitions des sites et des années demandés.
+"""
+
+import os
+import re
+from functools import lru_cache
+from threading import Lock
+
+import pandas as pd
+
+COLONNES_ARCHIVE = ['id', 'date', 'type_releve_id', 'valeur', 'commentaire', 'utilisateur_id']
+_DOSSIER_SITE = re.compile(r'^site_(\d+)$')
+_PARTITION = re.compile(r'^releves_(\d{4})\.csv\.gz$')
+
+
+@lru_cache(maxsize=64)
+def _lire_partition(chemin, mtime_ns):
+    """Contenu d'une partition (mis en cache tant que le fichier n'est pas réécrit).
+    Le DataFrame retourné est partagé : ne pas le modifier"""
+    df = pd.read_csv(chemin, compression='gzip', dtype={'commentaire': object})
+    df['date'] = pd.to_datetime(df['date']).dt.date
+    df['commentaire'] = df['commentaire'].where(df['commentaire'].notna(), None)
+    return df
+
+
+def lire_partition(chemin):
+    try:
+        return _lire_partition(chemin, os.stat(chemin).st_mtime_ns)
+    except FileNotFoundError:
+        return pd.DataFrame(columns=COLONNES_ARCHIVE)
+
+
+class ArchiveReleves:
+    def __init__(self, dossier):
+        self.dossier = dossier
+        self._lock = Lock()
+
+    def chemin(self, site_id, annee):
+        return os.path.join(self.dossier, f'site_{site_id}', f'releves_{annee}.csv.gz')
+
+    def sites(self):
+        try:
+            noms = os.listdir(self.dossier)
+        except FileNotFoundError:
+            return []
+        return sorted(int(m.group(1)) for m in map(_DOSSIER_SITE.match, noms) if m)
+
+    def annees(self, site_id):
+        try:
+            noms = os.listdir(os.path.join(self.dossier, f'site_{site_id}'))
+        except FileNotFoundError:
+            return []
+        return sorted(int(m.group(1)) for m in map(_PARTITION.match, noms) if m)
+
+    def ajouter(self, site_id, releves):
+        """Archive les relevés d'un site (DataFrame aux colonnes COLONNES_ARCHIVE)"""
+        releves = releves[COLONNES_ARCHIVE].copy()
+        releves['date'] = pd.to_datetime(releves['date']).dt.date
+        annees = pd.to_datetime(releves['date']).dt.year
+        with self._lock:
+            for annee, groupe in releves.groupby(annees):
+                chemin = self.chemin(site_id, annee)
+                os.makedirs(os.path.dirname(chemin), exist_ok=True)
+                existant = lire_partition(chemin)
+                if not existant.empty:
+                    groupe = pd.concat([existant, groupe], ignore_index=True)
+                groupe = groupe.drop_duplicates('id', keep='last').sort_values(['date', 'type_releve_id'])
+                tmp_path = f'{chemin}.{os.getpid()}.part'
+                groupe.to_csv(tmp_path, index=False, compression='gzip')
+                os.replace(tmp_path, chemin)
+
+    def lire(self, site_ids=None, date_debut=None, date_fin=None):
+        """Relevés archivés des sites (tous par défaut) entre deux dates incluses, triés par date"""
+        morceaux = []
+        for site_id in (self.sites() if site_ids is None else site_ids):
+            for annee in self.annees(site_id):
+                if (date_debut and annee < date_debut.year) or (date_fin and annee > date_fin.year):
+                    continue
+                df = lire_partition(self.chemin(site_id, annee))
+                if date_debut:
+                    df = df[df['date'] >= date_debut]
+                if date_fin:
+                    df = df[df['date'] <= date_fin]
+                morceaux.append(df)
+        if not morceaux:
+            return pd.DataFrame(columns=COLONNES_ARCHIVE)
+        return pd.concat(morceaux, ignore_index=True).sort_values(['date', 'type_releve_id'], kind='stable')
+
+    def derniers_avant(self, site_ids, date, type_ids):
+        """Dernier relevé archivé strictement antérieur à date pour chacun des types, s'il existe.
+        Les partitions sont lues de l'année de date vers les plus anciennes, jusqu'à trouver tous les types"""
+        type_ids = set(type_ids)
+        morceaux = []
+        for site_id in (self.sites() if site_ids is None else site_ids):
+            restants = set(type_ids)
+            for annee in reversed(self.annees(site_id)):
+                if not restants:
+                    break
+                if annee > date.year:
+                    continue
+                df = lire_partition(self.chemin(site_id, annee))
+                df = df[(df['date'] < date) & df['type_releve_id'].isin(restants)]
+                if df.empty:
+                    continue
+                derniers = df.sort_values('date', kind='stable').groupby('type_releve_id').tail(1)
+                morceaux.append(derniers)
+                restants -= set(derniers['type_releve_id'])
+        if not morceaux:
+            return pd.DataFrame(columns=COLONNES_ARCHIVE)
+        return pd.concat(morceaux, ignore_index=True).sort_values(['date', 'type_releve_id'], kind='stable')
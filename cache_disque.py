@@ -0,0 +1,155 @@
+"""
+Cache disque borné en taille (graphiques, rapports PDF...)
+
+Les clés sont des empreintes du contenu, donc une entrée n'est jamais modifiée. Les
+écritures sont atomiques (fichier temporaire + os.replace). Quand la taille totale dépasse
+le maximum, les fichiers les moins récemment lus (date d'accès, mise à jour à chaque
+lecture) sont supprimés. Plusieurs workers gunicorn peuvent partager le même dossier :
+une entrée disparue entre-temps est simplement un défaut de cache.
+"""
+
+import hashlib
+import os
+import time
+from threading import Lock
+
+# Les fichiers lus il y a moins de DELAI_GRACE secondes ne sont jamais évincés :
+# un chemin renvoyé par chemin_si_present() reste lisible le temps de s'en servir
+DELAI_GRACE = 60
+# Après éviction, on redescend à cette fraction du maximum pour ne pas évincer à chaque écriture
+TAUX_APRES_EVICTION = 0.9
+# Taille totale relue sur le disque toutes les N écritures (les autres workers écrivent aussi)
+RELECTURE_TOUTES_LES = 50
+
+
+def cle_contenu(*parties):
+    """Clé sha1 de plusieurs parties (str ou bytes)"""
+    empreinte = hashlib.sha1()
+    for partie in parties:
+        empreinte.update(partie if isinstance(partie, bytes) else str(partie).encode('utf-8'))
+        empreinte.update(b'\0')
+    return empreinte.hexdigest()
+
+
+class CacheDisque:
+    def __init__(self, dossier, taille_max, extension=''):
+        self.dossier = dossier
+        self.taille_max = taille_max
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self._taille = None  # estimation, relue sur le disque au besoin
+        self._ecritures = 0
+
+    def chemin(self, cle):
+        return os.path.join(self.dossier, f'{cle}{self.extension}')
+
+    def _toucher(self, chemin):
+        """Marque l'entrée comme lue (les disques montés en noatime/relatime ne le font pas)"""
+        try:
+            os.utime(chemin, (time.time(), os.stat(chemin).st_mtime))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def chemin_si_present(self, cle):
+        """Chemin de l'entrée si elle est en cache (compte un hit), sinon None (compte un miss)"""
+        chemin = self.chemin(cle)
+        present = self._toucher(chemin)
+        with self._lock:
+            if present:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return chemin if present else None
+
+    def lire(self, cle):
+        """Contenu de l'entrée, ou None"""
+        chemin = self.chemin_si_present(cle)
+        if chemin is None:
+            return None
+        try:
+            with open(chemin, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def ecrire(self, cle, contenu):
+        """Écrit l'entrée de façon atomique et retourne son chemin"""
+        os.makedirs(self.dossier, exist_ok=True)
+        chemin = self.chemin(cle)
+        tmp_path = f'{chemin}.{os.getpid()}.part'
+        with open(tmp_path, 'wb') as f:
+            f.write(contenu)
+        os.replace(tmp_path, chemin)
+        with self._lock:
+            self._ecritures += 1
+            if self._taille is None or self._ecritures % RELECTURE_TOUTES_LES == 0:
+                self._taille = self._taille_disque()
+            else:
+                self._taille += len(contenu)
+            depasse = self._taille > self.taille_max
+        if depasse:
+            self.evincer()
+        return chemin
+
+    def _entrees(self):
+        entrees = []
+        try:
+            with os.scandir(self.dossier) as it:
+                for entree in it:
+                    if not entree.is_file() or not entree.name.endswith(self.extension) or entree.name.endswith('.part'):
+                        continue
+                    try:
+                        stat = entree.stat()
+                    except FileNotFoundError:
+                        continue
+                    entrees.append((stat.st_atime, stat.st_size, entree.path))
+        except FileNotFoundError:
+            pass
+        return entrees
+
+    def _taille_disque(self):
+        return sum(taille for _, taille, _ in self._entrees())
+
+    def evincer(self):
+        """Supprime les entrées les moins récemment lues jusqu'à repasser sous le maximum"""
+        entrees = sorted(self._entrees())
+        taille = sum(t for _, t, _ in entrees)
+        cible = self.taille_max * TAUX_APRES_EVICTION
+        limite_grace = time.time() - DELAI_GRACE
+        supprimees = 0
+        for acces, taille_fichier, chemin in entrees:
+            if taille <= cible or acces > limite_grace:
+                break
+            try:
+                os.remove(chemin)
+                supprimees += 1
+            except FileNotFoundError:
+                pass  # déjà évincée par un autre worker
+            taille -= taille_fichier
+        with self._lock:
+            self._taille = taille
+            self.evictions += supprimees
+        return supprimees
+
+    def supprimer(self, cle):
+        try:
+            os.remove(self.chemin(cle))
+        except FileNotFoundError:
+            pass
+
+    def statistiques(self):
+        entrees = self._entrees()
+        with self._lock:
+            return {
+                'dossier': self.dossier,
+                'fichiers': len(entrees),
+                'taille': sum(t for _, t, _ in entrees),
+                'taille_max': self.taille_max,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,125 @@
+"""
+Construction et envoi des emails avec pièces jointes, sans charger les fichiers en mémoire
+
+Le message MIME est écrit dans un fichier : les pièces jointes sont lues et encodées en
+base64 par blocs. Il est ensuite transmis au serveur SMTP ligne à ligne (commande DATA),
+si bien que la mémoire utilisée ne dépend pas de la taille des pièces jointes.
+"""
+
+import base64
+import mimetypes
+import os
+import secrets
+import smtplib
+from email.header import Header
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from email.utils import encode_rfc2231, formatdate, make_msgid
+
+# 57 octets donnent une ligne base64 de 76 caractères (limite MIME) : les blocs en sont des multiples
+TAILLE_BLOC = 57 * 1024
+# Octets envoyés au serveur par appel à send()
+TAILLE_ENVOI = 64 * 1024
+# Taille encodée ≈ 4/3 de la taille brute, plus les fins de ligne
+FACTEUR_BASE64 = 4 / 3 * 78 / 76
+# En-têtes et corps HTML, largement
+MARGE_MESSAGE = 64 * 1024
+
+TYPES_PIECES_JOINTES = {
+    '.zip': 'application/zip',
+    '.pdf': 'application/pdf',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+
+def taille_brute_max(taille_message_max):
+    """Taille cumulée des pièces jointes qui tient dans un message de taille_message_max octets"""
+    return int((taille_message_max - MARGE_MESSAGE) / FACTEUR_BASE64)
+
+
+def type_piece_jointe(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return TYPES_PIECES_JOINTES.get(extension) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _en_tete(nom, valeur):
+    """En-tête encodé (RFC 2047) seulement s'il contient des caractères non ASCII"""
+    if not valeur.isascii():
+        valeur = Header(valeur, 'utf-8').encode()
+    return f'{nom}: {valeur}\r\n'.encode('ascii')
+
+
+def ecrire_message(sortie, expediteur, destinataire, subject, body, attachments):
+    """Écrit dans le fichier binaire `sortie` le message complet (fins de ligne CRLF).
+    attachments : [{'path', 'filename'}]"""
+    frontiere = '=_' + secrets.token_hex(16)
+    sortie.write(_en_tete('From', expediteur))
+    sortie.write(_en_tete('To', destinataire))
+    sortie.write(_en_tete('Subject', subject))
+    sortie.write(f'Date: {formatdate(localtime=True)}\r\n'.encode('ascii'))
+    sortie.write(f'Message-ID: {make_msgid()}\r\n'.encode('ascii'))
+    sortie.write(b'MIME-Version: 1.0\r\n')
+    sortie.write(f'Content-Type: multipart/mixed; boundary="{frontiere}"\r\n\r\n'.encode('ascii'))
+
+    # Corps HTML : petit, encodé par le paquet email
+    sortie.write(f'--{frontiere}\r\n'.encode('ascii'))
+    corps = MIMEText(body, 'html', 'utf-8')
+    del corps['MIME-Version']
+    sortie.write(corps.as_bytes(policy=SMTP))
+    sortie.write(b'\r\n')
+
+    for attachment in attachments:
+        filename = attachment['filename']
+        sortie.write(f'--{frontiere}\r\n'.encode('ascii'))
+        sortie.write(f'Content-Type: {type_piece_jointe(filename)}\r\n'.encode('ascii'))
+        sortie.write(b'Content-Transfer-Encoding: base64\r\n')
+        if filename.isascii():
+            disposition = f'filename="{filename}"'
+        else:
+            disposition = f"filename*={encode_rfc2231(filename, 'utf-8')}"
+        sortie.write(f'Content-Disposition: attachment; {disposition}\r\n\r\n'.encode('ascii'))
+        with open(attachment['path'], 'rb') as f:
+            while True:
+                bloc = f.read(TAILLE_BLOC)
+                if not bloc:
+                    break
+                sortie.write(base64.encodebytes(bloc).replace(b'\n', b'\r\n'))
+    sortie.write(f'--{frontiere}--\r\n'.encode('ascii'))
+
+
+def envoyer_message(serveur, expediteur, destinataire, chemin_message):
+    """Transmet le message du fichier chemin_message sur une connexion SMTP ouverte
+    (équivalent de serveur.sendmail, sans lire le fichier d'un coup)"""
+    serveur.ehlo_or_helo_if_needed()
+    code, reponse = serveur.mail(expediteur)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, reponse, expediteur)
+    code, reponse = serveur.rcpt(destinataire)
+    if code not in (250, 251):
+        serveur.rset()
+        raise smtplib.SMTPRecipientsRefused({destinataire: (code, reponse)})
+    serveur.putcmd('data')
+    code, reponse = serveur.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, reponse)
+
+    tampon = bytearray()
+    ligne = b'\r\n'
+    with open(chemin_message, 'rb') as f:
+        for ligne in f:
+            # Transparence SMTP : une ligne commençant par un point est doublée
+            if ligne.startswith(b'.'):
+                tampon += b'.'
+            tampon += ligne
+            if len(tampon) >= TAILLE_ENVOI:
+                serveur.send(bytes(tampon))
+                tampon.clear()
+    if not ligne.endswith(b'\r\n'):
+        tampon += b'\r\n'
+    tampon += b'.\r\n'
+    serveur.send(bytes(tampon))
+    code, reponse = serveur.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, reponse)
@@ -0,0 +1,44 @@
+"""
+Rendu des graphiques du rapport PDF
+
+Utilise l'API objet de matplotlib (Figure + canvas Agg) et jamais pyplot :
+aucun état global, donc utilisable depuis plusieurs threads ou processus.
+Ce module n'importe pas l'application Flask pour rester léger dans les
+processus de rendu.
+"""
+
+import hashlib
+import io
+import json
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# À incrémenter si l'aspect des graphiques change (invalide les images en cache)
+VERSION_RENDU = 1
+
+
+def cle_graphique(titre, unite, dates, valeurs):
+    """Empreinte md5 des données d'un graphique (nom du fichier en cache)"""
+    donnees = json.dumps([VERSION_RENDU, titre, unite, dates, valeurs], ensure_ascii=False)
+    return hashlib.md5(donnees.encode('utf-8')).hexdigest()
+
+
+def rendre_graphique(titre, unite, dates, valeurs):
+    """Courbe d'une série au format PNG (bytes)"""
+    fig = Figure(figsize=(6, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if valeurs:
+        ax.plot(dates, valeurs, marker='o')
+    else:
+        ax.text(0.5, 0.5, 'Aucune donnée pour cette période', ha='center', va='center',
+                fontsize=12, color='red', transform=ax.transAxes)
+    ax.set_title(titre)
+    ax.set_xlabel('Date')
+    ax.set_ylabel(f"Valeur ({unite})")
+    ax.tick_params(axis='x', labelrotation=45, labelsize=7)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
@@ -0,0 +1,68 @@
+"""
+Traitement des photos de relevé (Pillow)
+
+L'orientation EXIF est appliquée et la résolution plafonnée. La photo conservée est
+ré-encodée en JPEG, sans métadonnées. Deux variantes WebP légères sont aussi produites :
+une vignette pour les galeries et un aperçu pour l'affichage plein écran.
+"""
+
+import os
+
+from PIL import Image, ImageOps
+
+TAILLE_MAX = 2560          # plus grand côté de la photo conservée (px)
+VARIANTES = {              # plus grand côté des variantes (px)
+    'vignette': 320,
+    'apercu': 1280,
+}
+QUALITE_JPEG = 85
+QUALITE_WEBP = 80
+
+
+def nom_traite(fichier):
+    """Nom de la photo conservée après traitement"""
+    return f'{os.path.splitext(fichier)[0]}.jpg'
+
+
+def nom_variante(fichier, variante):
+    return f'{os.path.splitext(fichier)[0]}_{variante}.webp'
+
+
+def est_variante(fichier):
+    """Les variantes ne sont jamais réécrites : elles peuvent être mises en cache indéfiniment"""
+    return any(fichier.endswith(f'_{variante}.webp') for variante in VARIANTES)
+
+
+def fichiers_photo(fichier):
+    """Tous les fichiers qu'une photo peut occuper dans le dossier d'upload"""
+    return [fichier, nom_traite(fichier)] + [nom_variante(fichier, v) for v in VARIANTES]
+
+
+def _enregistrer(image, chemin, **options):
+    """Écriture atomique : les lecteurs ne voient jamais un fichier à moitié écrit"""
+    tmp_path = f'{chemin}.{os.getpid()}.part'
+    image.save(tmp_path, **options)
+    os.replace(tmp_path, chemin)
+
+
+def traiter_photo(dossier, fichier):
+    """Traite dossier/fichier et écrit la photo conservée et ses variantes.
+    Retourne le nom de la photo conservée (l'original n'est pas supprimé)"""
+    with Image.open(os.path.join(dossier, fichier)) as source:
+        # JPEG : décodage directement à une échelle réduite, bien moins coûteux en mémoire
+        source.draft('RGB', (TAILLE_MAX, TAILLE_MAX))
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+    image.thumbnail((TAILLE_MAX, TAILLE_MAX), Image.Resampling.LANCZOS)
+    conserve = nom_traite(fichier)
+    _enregistrer(image, os.path.join(dossier, conserve), format='JPEG',
+                 quality=QUALITE_JPEG, optimize=True, progressive=True)
+
+    for variante, taille in VARIANTES.items():
+        reduite = image.copy()
+        reduite.thumbnail((taille, taille), Image.Resampling.LANCZOS)
+        _enregistrer(reduite, os.path.join(dossier, nom_variante(fichier, variante)),
+                     format='WEBP', quality=QUALITE_WEBP, method=4)
+    return conserve
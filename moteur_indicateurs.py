@@ -0,0 +1,110 @@
+"""
+Moteur de calcul des indicateurs (débits journaliers, semaines ISO, statistiques)
+
+Les relevés d'une période sont chargés en une seule requête dans un DataFrame
+(colonnes type_releve_id, nom, type_mesure, unite, site, date, valeur, precalcule) ;
+tous les calculs sont vectorisés avec pandas/NumPy. Les lignes `precalcule`
+contiennent déjà un débit (table ConsommationJournaliere) et ne sont pas redifférenciées.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Règles de calcul par type de mesure (définies une seule fois)
+REGLE_DIFFERENCE = 'difference'              # totalisateurs : débit = index du jour - index précédent
+REGLE_DIFFERENCE_HEBDO = 'difference_hebdo'  # eau potable hors totalisateur : différence, libellé semaine
+REGLE_HEBDO = 'hebdo'                        # coagulant : valeur brute, libellé semaine
+REGLE_BRUT = 'brut'                          # relevés basiques : valeur brute
+
+COLONNES_RELEVES = ['type_releve_id', 'nom', 'type_mesure', 'unite', 'site', 'date', 'valeur', 'precalcule']
+
+
+def regles_vectorisees(df):
+    """Règle de chaque ligne du DataFrame : totalisateur, puis Eau potable, puis Coagulant, sinon brut"""
+    return np.select(
+        [df['type_mesure'] == 'totalisateur', df['nom'] == 'Eau potable', df['nom'] == 'Coagulant'],
+        [REGLE_DIFFERENCE, REGLE_DIFFERENCE_HEBDO, REGLE_HEBDO],
+        default=REGLE_BRUT
+    )
+
+
+def calculer_series(releves):
+    """Applique les règles à tous les types à la fois.
+
+    Retourne un DataFrame trié par type puis date, avec la colonne `valeur`
+    calculée et un `libelle` (date AAAA-MM-JJ ou semaine ISO "S12-2025").
+    Pour les règles à différence non précalculées, la première valeur de chaque type disparaît.
+    """
+    if releves.empty:
+        return releves.assign(libelle=pd.Series(dtype=str))
+
+    df = releves.sort_values(['type_releve_id', 'date'], kind='stable').reset_index(drop=True)
+    regles = regles_vectorisees(df)
+    avec_difference = np.isin(regles, [REGLE_DIFFERENCE, REGLE_DIFFERENCE_HEBDO]) & ~df['precalcule'].to_numpy(dtype=bool)
+
+    difference = df.groupby('type_releve_id', sort=False)['valeur'].diff()
+    df['valeur'] = np.where(avec_difference, difference, df['valeur'])
+    garder = ~(avec_difference & difference.isna().to_numpy())
+    df = df[garder].reset_index(drop=True)
+    regles = regles[garder]
+
+    dates = pd.to_datetime(df['date'])
+    iso = dates.dt.isocalendar()
+    libelle_semaine = 'S' + iso['week'].astype(str) + '-' + iso['year'].astype(str)
+    libelle_date = dates.dt.strftime('%Y-%m-%d')
+    df['libelle'] = np.where(np.isin(regles, [REGLE_DIFFERENCE_HEBDO, REGLE_HEBDO]), libelle_semaine, libelle_date)
+    return df
+
+
+def statistiques(series):
+    """Moyenne, min, max, total et nombre de valeurs par type (une seule agrégation groupée)"""
+    return series.groupby('type_releve_id')['valeur'].agg(
+        moyenne='mean', min='min', max='max', total='sum', nombre='count'
+    )
+
+
+def series_json(series):
+    """Séries au format de l'API indicateurs : [{nom, unite, valeurs: [{date, valeur}]}]"""
+    stats = statistiques(series)
+    result = []
+    for type_releve_id, groupe in series.groupby('type_releve_id', sort=True):
+        stat = stats.loc[type_releve_id]
+        result.append({
+            'nom': groupe['nom'].iat[0],
+            'unite': groupe['unite'].iat[0],
+            'valeurs': [
+                {'date': libelle, 'valeur': valeur}
+                for libelle, valeur in zip(groupe['libelle'].tolist(), groupe['valeur'].tolist())
+            ],
+            'statistiques': {
+                'moyenne': float(stat['moyenne']),
+                'min': float(stat['min']),
+                'max': float(stat['max']),
+                'total': float(stat['total'])
+            }
+        })
+    return result
+
+
+def statistiques_par_periode(releves, periode=None):
+    """Moyenne, min, max, total et nombre par type (et par semaine ou mois si `periode`).
+    Valeurs brutes, sauf les totalisateurs non précalculés, ramenés à leur débit par différence.
+    Retourne un DataFrame (type_releve_id, [debut_periode,] moyenne, min, max, total, nombre)"""
+    df = releves.sort_values(['type_releve_id', 'date'], kind='stable').reset_index(drop=True)
+    avec_difference = ((df['type_mesure'] == 'totalisateur') & ~df['precalcule'].astype(bool)).to_numpy()
+    difference = df.groupby('type_releve_id', sort=False)['valeur'].diff()
+    df['valeur'] = np.where(avec_difference, difference, df['valeur'])
+    df = df[~(avec_difference & difference.isna().to_numpy())]
+
+    cles = ['type_releve_id']
+    if periode:
+        dates = pd.to_datetime(df['date'])
+        if periode == 'semaine':
+            debut = dates - pd.to_timedelta(dates.dt.weekday, unit='D')
+        else:
+            debut = dates.dt.to_period('M').dt.start_time
+        df = df.assign(debut_periode=debut.dt.date)
+        cles.append('debut_periode')
+    return df.groupby(cles)['valeur'].agg(
+        moyenne='mean', min='min', max='max', total='sum', nombre='count'
+    ).reset_index()
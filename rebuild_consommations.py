@@ -0,0 +1,6 @@
+from app import app, rebuild_consommations
+
+if __name__ == "__main__":
+    with app.app_context():
+        rebuild_consommations()
+    print("Débits journaliers recalculés avec succès.")
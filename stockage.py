@@ -0,0 +1,107 @@
+"""
+Mesure de l'espace réellement occupé (base de données, dossiers de fichiers)
+
+Base : taille de chaque table sur PostgreSQL (pg_total_relation_size : données, index,
+TOAST) ; sur SQLite, pages du fichier (page_count * page_size, dont les pages libres) et
+journal WAL. Dossiers : parcours mis en cache, un dossier dont la date de modification
+n'a pas changé n'est pas relu (les fichiers y sont ajoutés, remplacés ou supprimés, ce qui
+modifie cette date).
+"""
+
+import os
+from threading import Lock
+
+from sqlalchemy import text
+
+
+def taille_base(connexion):
+    """{'taille', 'libre', 'tables': {nom: octets}} de la base de la connexion"""
+    dialecte = connexion.dialect.name
+    if dialecte == 'postgresql':
+        return _taille_postgresql(connexion)
+    if dialecte == 'sqlite':
+        return _taille_sqlite(connexion)
+    raise ValueError(f"Dialecte non pris en charge : {dialecte}")
+
+
+def _taille_postgresql(connexion):
+    tables = dict(connexion.execute(text(
+        "SELECT c.relname, pg_total_relation_size(c.oid) FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind IN ('r', 'p', 'm') AND n.nspname = current_schema()"
+    )).all())
+    taille = connexion.execute(text("SELECT pg_database_size(current_database())")).scalar()
+    return {'taille': taille, 'libre': None, 'tables': tables}
+
+
+def _taille_sqlite(connexion):
+    page_size = connexion.execute(text("PRAGMA page_size")).scalar()
+    page_count = connexion.execute(text("PRAGMA page_count")).scalar()
+    freelist = connexion.execute(text("PRAGMA freelist_count")).scalar()
+    taille = page_count * page_size
+    chemin = connexion.engine.url.database
+    if chemin and chemin != ':memory:':
+        try:
+            taille += os.path.getsize(f'{chemin}-wal')
+        except OSError:
+            pass
+    try:
+        # Table virtuelle dbstat : seulement si SQLite est compilé avec SQLITE_ENABLE_DBSTAT_VTAB
+        tables = dict(connexion.execute(text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")).all())
+    except Exception:
+        tables = {}
+    return {'taille': taille, 'libre': freelist * page_size, 'tables': tables}
+
+
+class ParcoursDossiers:
+    """Taille et nombre de fichiers d'arborescences, avec un cache par dossier"""
+
+    def __init__(self):
+        self._cache = {}  # (chemin, préfixe) -> (mtime_ns, octets, fichiers, sous-dossiers)
+        self._lock = Lock()
+
+    def mesurer(self, chemin, prefixe=None):
+        """(octets, fichiers) sous chemin ; avec un préfixe, seuls les fichiers du dossier
+        lui-même dont le nom commence par ce préfixe sont comptés (pas les sous-dossiers)"""
+        with self._lock:
+            vus = set()
+            resultat = self._mesurer(chemin, prefixe, vus)
+            # Dossiers disparus depuis le dernier parcours
+            for cle in [c for c in self._cache if c[0] not in vus and c[0].startswith(chemin + os.sep)]:
+                del self._cache[cle]
+            return resultat
+
+    def _mesurer(self, chemin, prefixe, vus):
+        vus.add(chemin)
+        cle = (chemin, prefixe)
+        try:
+            mtime = os.stat(chemin).st_mtime_ns
+        except FileNotFoundError:
+            self._cache.pop(cle, None)
+            return 0, 0
+        entree = self._cache.get(cle)
+        if entree is None or entree[0] != mtime:
+            octets = fichiers = 0
+            sous_dossiers = []
+            try:
+                with os.scandir(chemin) as it:
+                    for element in it:
+                        try:
+                            if element.is_dir(follow_symlinks=False):
+                                if prefixe is None:
+                                    sous_dossiers.append(element.path)
+                            elif element.is_file(follow_symlinks=False) and element.name.startswith(prefixe or ''):
+                                octets += element.stat(follow_symlinks=False).st_size
+                                fichiers += 1
+                        except FileNotFoundError:
+                            continue
+            except FileNotFoundError:
+                return 0, 0
+            entree = (mtime, octets, fichiers, sous_dossiers)
+            self._cache[cle] = entree
+        _, octets, fichiers, sous_dossiers = entree
+        for sous_dossier in sous_dossiers:
+            o, f = self._mesurer(sous_dossier, None, vus)
+            octets += o
+            fichiers += f
+        return octets, fichiers
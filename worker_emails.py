@@ -0,0 +1,6 @@
+from app import boucle_outbox
+
+if __name__ == "__main__":
+    # Worker dédié : envoie les emails de la file d'envoi en dehors des workers web
+    print("Worker d'envoi des emails démarré.")
+    boucle_outbox()
@@ -0,0 +1,6 @@
+from app import boucle_rapports
+
+if __name__ == "__main__":
+    # Worker dédié : traite la file des rapports PDF en dehors des workers web
+    print("Worker des rapports PDF démarré.")
+    boucle_rapports()